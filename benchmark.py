@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks for javanicus, run against fakewebhdfs.
+
+Each benchmark gets a fresh fake cluster and a fresh Javanicus instance,
+seeds whatever data it needs directly into the fake, then drives javanicus
+through the same calls fuse would make, timing each operation.  No mount
+(or root, or libfuse daemon) is needed.
+
+Results are written as json, one record per benchmark, with the number of
+operations, operations per second, median and 99th percentile latency, and
+how many requests went to the namenode and to datanodes.
+
+    $ ./benchmark.py --latency 2 --bandwidth 100 --output before.json
+    $ ./benchmark.py seq_read random_read --option readahead_max=0
+'''
+
+import argparse
+import collections
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+import fuse
+
+import javanicus
+from fakewebhdfs import FakeWebHDFS
+
+
+BENCHMARKS = collections.OrderedDict()
+
+CHUNK_SIZE = 128 * 1024
+MB = 1024 * 1024
+
+
+def benchmark(function):
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+######
+######
+## Benchmarks
+##
+## Each one is a generator that's handed the fake cluster, the mounted
+## Javanicus instance, a scale factor and a random number generator.  It
+## yields operations to time, as callables returning how many bytes of file
+## data they moved.  Anything it does between yields isn't timed.
+
+@benchmark
+def stat_storm(fs, mount, scale, rng):
+    '''getattr on every file in a directory, over and over'''
+    paths = ['/stat/f%06d' % i for i in xrange(2000 * scale)]
+    for path in paths:
+        fs.write_file(path, '')
+
+    def op(path):
+        mount('getattr', path)
+        return 0
+
+    paths = paths * 5
+    rng.shuffle(paths)
+    for path in paths:
+        yield lambda path=path: op(path)
+
+
+@benchmark
+def list_dir(fs, mount, scale, rng):
+    '''lists a big directory the way the kernel would, a page at a time'''
+    for i in xrange(20000 * scale):
+        fs.write_file('/list/f%06d' % i, '')
+
+    def op():
+        fh = mount('opendir', '/list')
+        offset = 0
+        while True:
+            # the kernel takes about a page worth of entries per call
+            entries = []
+            for entry in mount('readdir', '/list', fh, offset):
+                entries.append(entry)
+                if len(entries) == 128:
+                    break
+            if not entries:
+                break
+            offset = entries[-1][2]
+        mount('releasedir', '/list', fh)
+        return 0
+
+    for i in xrange(5):
+        yield op
+
+
+@benchmark
+def seq_read(fs, mount, scale, rng):
+    '''reads a big file front to back'''
+    size = 64 * MB * scale
+    fs.write_file('/seq', os.urandom(size))
+    fh = mount('open', '/seq', os.O_RDONLY)
+    for offset in xrange(0, size, CHUNK_SIZE):
+        yield lambda offset=offset: len(mount('read', '/seq', CHUNK_SIZE,
+                                              offset, fh))
+    mount('release', '/seq', fh)
+
+
+@benchmark
+def random_read(fs, mount, scale, rng):
+    '''small reads from random places in a big file'''
+    size = 64 * MB * scale
+    fs.write_file('/random', os.urandom(size))
+    fh = mount('open', '/random', os.O_RDONLY)
+    for i in xrange(2000 * scale):
+        offset = rng.randrange(0, size - 4096)
+        yield lambda offset=offset: len(mount('read', '/random', 4096,
+                                              offset, fh))
+    mount('release', '/random', fh)
+
+
+@benchmark
+def small_files(fs, mount, scale, rng):
+    '''creates lots of little files'''
+    fs.mkdirs('/small')
+    data = os.urandom(4096)
+
+    def op(path):
+        fh = mount('create', path, 0644)
+        mount('write', path, data, 0, fh)
+        mount('flush', path, fh)
+        mount('release', path, fh)
+        return len(data)
+
+    for i in xrange(500 * scale):
+        yield lambda path='/small/f%06d' % i: op(path)
+
+
+@benchmark
+def large_write(fs, mount, scale, rng):
+    '''writes a big file front to back, closing it counts as the last op'''
+    size = 64 * MB * scale
+    data = os.urandom(CHUNK_SIZE)
+    fh = mount('create', '/large', 0644)
+    for offset in xrange(0, size, CHUNK_SIZE):
+        yield lambda offset=offset: mount('write', '/large', data, offset, fh)
+
+    def close():
+        mount('flush', '/large', fh)
+        mount('release', '/large', fh)
+        return 0
+    yield close
+
+
+######
+######
+## Harness
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    index = min(int(round(fraction * (len(latencies) - 1))),
+                len(latencies) - 1)
+    return latencies[index]
+
+
+def run(name, scale, seed, fake_options, options):
+    fs = FakeWebHDFS(**fake_options).start()
+    mount = javanicus.Javanicus(fs.host, fs.port, debug=False, **options)
+    try:
+        latencies = []
+        moved = 0
+        operations = BENCHMARKS[name](fs, mount, scale, random.Random(seed))
+
+        # seeding happens on the first next(), so counting starts after it
+        op = next(operations, None)
+        fs.reset_counts()
+        start = time.time()
+        while op is not None:
+            op_start = time.time()
+            moved += op() or 0
+            latencies.append(time.time() - op_start)
+            op = next(operations, None)
+
+        # whatever's still queued up (write-back, say) counts too
+        mount('destroy', '/')
+        mount = None
+        elapsed = time.time() - start
+    finally:
+        if mount is not None:
+            mount('destroy', '/')
+        fs.stop()
+
+    latencies.sort()
+    requests = dict(('%s.%s' % key, n) for key, n in fs.counts.items())
+    return {
+        'name': name,
+        'ops': len(latencies),
+        'seconds': elapsed,
+        'ops_per_sec': len(latencies) / elapsed if elapsed else None,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'bytes': moved,
+        'mb_per_sec': moved / float(MB) / elapsed if elapsed else None,
+        'namenode_requests': sum(n for (node, op), n in fs.counts.items()
+                                 if node == 'namenode'),
+        'datanode_requests': sum(n for (node, op), n in fs.counts.items()
+                                 if node == 'datanode'),
+        'requests': requests,
+    }
+
+
+def parse_option(option):
+    # name=value, where value is read as json if it can be, so numbers and
+    # true/false come through as such
+    name, _, value = option.partition('=')
+    try:
+        value = json.loads(value)
+    except ValueError:
+        pass
+    return name.replace('-', '_'), value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark javanicus against a fake WebHDFS cluster')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run, from: %s (default: all)'
+                             % ', '.join(BENCHMARKS))
+    parser.add_argument('--scale', type=int, default=1,
+                        help='multiplies the size of every benchmark')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds of latency to add to each request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='datanode bandwidth to simulate, in MB/s')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='entries per page of a batched listing')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the random parts of benchmarks')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='pass an option through to Javanicus, eg. '
+                             'readahead_max=0 or writeback=true')
+    parser.add_argument('--output', default='-',
+                        help='where to write the json results')
+    args = parser.parse_args()
+
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % name)
+    names = args.benchmarks or list(BENCHMARKS)
+
+    fake_options = {
+        'latency': args.latency / 1000.0,
+        'bandwidth': args.bandwidth * MB if args.bandwidth else None,
+        'batch_size': args.batch_size,
+    }
+    options = dict(parse_option(option) for option in args.option)
+
+    # there's no fuse context outside of a mount, so everything runs as us
+    fuse.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+    logging.basicConfig(level=logging.WARN)
+
+    results = []
+    for name in names:
+        result = run(name, args.scale, args.seed, fake_options, options)
+        sys.stderr.write('%-12s %8d ops %10.1f ops/s  p50 %8.3fms  '
+                         'p99 %8.3fms  %6d namenode requests\n'
+                         % (name, result['ops'], result['ops_per_sec'],
+                            result['p50_ms'], result['p99_ms'],
+                            result['namenode_requests']))
+        results.append(result)
+
+    output = {
+        'config': {
+            'scale': args.scale,
+            'seed': args.seed,
+            'fake': fake_options,
+            'options': options,
+        },
+        'results': results,
+    }
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+'''
+Regression checks for javanicus, run against fakewebhdfs.
+
+Each check gets a fresh fake cluster and a scratch directory, mounts
+Javanicus on it as many times as it needs (the way benchmark.py does, with
+no real mount), and makes sure what comes back out is what went in.  It
+prints a line per check, and exits non-zero if any of them failed.
+
+    $ ./check.py
+    $ ./check.py append_then_read
+'''
+
+import argparse
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import fuse
+
+import javanicus
+from fakewebhdfs import FakeWebHDFS
+
+
+CHECKS = collections.OrderedDict()
+
+MB = 1024 * 1024
+
+
+def check(function):
+    CHECKS[function.__name__] = function
+    return function
+
+
+def expect(actual, expected, what):
+    if actual != expected:
+        raise AssertionError('%s: expected %.40r, got %.40r'
+                             % (what, expected, actual))
+
+
+def read_all(mount, path):
+    fh = mount('open', path, os.O_RDONLY)
+    try:
+        size = mount('getattr', path, fh)['st_size']
+        return mount('read', path, size, 0, fh)
+    finally:
+        mount('release', path, fh)
+
+
+######
+######
+## Checks
+##
+## Each one is handed the fake cluster, a directory it can use as a
+## --cache-dir, and a function that mounts a new Javanicus instance on the
+## fake, given any options to pass it.  Mounting again unmounts whatever was
+## mounted before, the way a remount would.
+
+@check
+def append_then_read(fs, cache_dir, mount):
+    '''appending to a file we never read leaves the rest of it intact'''
+    data = os.urandom(3 * MB)
+    fs.write_file('/log', data)
+
+    first = mount(cache_dir=cache_dir)
+    fh = first('open', '/log', os.O_WRONLY | os.O_APPEND)
+    first('write', '/log', 'tail\n', len(data), fh)
+    first('flush', '/log', fh)
+    data += 'tail\n'
+    expect(fs.read_file('/log'), data, 'server copy')
+    expect(read_all(first, '/log'), data, 'read while still open')
+    first('release', '/log', fh)
+    expect(read_all(first, '/log'), data, 'read after closing')
+
+    second = mount(cache_dir=cache_dir)
+    expect(read_all(second, '/log'), data, 'read after a remount')
+
+
+@check
+def utimens_before_close(fs, cache_dir, mount):
+    '''setting a file's times before closing it keeps what was written'''
+    for validate in ('status', 'checksum'):
+        path = '/copied-%s' % validate
+        instance = mount(validate=validate, lease=0.1)
+        fh = instance('create', path, 0644)
+        instance('write', path, 'payload', 0, fh)
+        # cp -p and rsync -t set the times before they close
+        instance('utimens', path, (1000000000, 1000000000))
+        time.sleep(0.2)
+        instance('flush', path, fh)
+        instance('release', path, fh)
+        expect(fs.read_file(path), 'payload', 'server copy')
+
+
+######
+######
+## Harness
+
+def run(name):
+    fs = FakeWebHDFS().start()
+    cache_dir = tempfile.mkdtemp(prefix='javanicus-check')
+    mounted = []
+
+    def unmount():
+        if mounted:
+            mounted.pop()('destroy', '/')
+
+    def mount(**options):
+        unmount()
+        mounted.append(javanicus.Javanicus(fs.host, fs.port, debug=False,
+                                           **options))
+        return mounted[-1]
+
+    try:
+        CHECKS[name](fs, cache_dir, mount)
+    finally:
+        try:
+            unmount()
+        finally:
+            fs.stop()
+            shutil.rmtree(cache_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check javanicus against a fake WebHDFS cluster')
+    parser.add_argument('checks', nargs='*', metavar='check',
+                        help='checks to run, from: %s (default: all)'
+                             % ', '.join(CHECKS))
+    args = parser.parse_args()
+
+    for name in args.checks:
+        if name not in CHECKS:
+            parser.error('unknown check %s' % name)
+    names = args.checks or list(CHECKS)
+
+    # there's no fuse context outside of a mount, so everything runs as us
+    fuse.fuse_get_context = lambda: (os.getuid(), os.getgid(), os.getpid())
+    logging.basicConfig(level=logging.WARN)
+
+    failed = 0
+    for name in names:
+        try:
+            run(name)
+        except Exception:
+            failed += 1
+            sys.stderr.write('%-24s FAIL\n' % name)
+            traceback.print_exc()
+        else:
+            sys.stderr.write('%-24s ok\n' % name)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
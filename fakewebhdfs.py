@@ -0,0 +1,514 @@
+#!/usr/bin/env python
+
+'''
+An in-process stand-in for a WebHDFS namenode and datanode.
+
+Implements the subset of the WebHDFS REST API that javanicus uses, keeping
+the whole filesystem in memory.  Data operations are answered by the
+namenode with a 307 redirect to a separate datanode port, the same way a
+real cluster does it.  Latency and bandwidth can be injected to make
+benchmark numbers look more like a real network.
+'''
+
+import BaseHTTPServer
+import SocketServer
+import bisect
+import hashlib
+import json
+import threading
+import time
+import urllib
+import urlparse
+
+
+class FakeWebHDFS(object):
+    '''
+    Holds the in-memory filesystem and runs a namenode and a datanode
+    HTTP server in background threads.
+    '''
+    BLOCK_SIZE = 128 * 1024 * 1024
+
+
+    def __init__(self, host='127.0.0.1', latency=0.0, bandwidth=None,
+                 owner='hdfs', group='supergroup', batch_size=1000,
+                 support_batch=True):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.owner = owner
+        self.group = group
+        self.batch_size = batch_size
+        self.support_batch = support_batch
+
+        # a standby namenode turns everything down with a StandbyException
+        self.standby = False
+
+        self._lock = threading.RLock()
+        self._files = {'/': self._new_status('DIRECTORY', '755')}
+        self._data = {}
+        self.counts = {}
+
+        self._namenode = _Server((host, 0), _NamenodeHandler, self)
+        self._datanode = _Server((host, 0), _DatanodeHandler, self)
+        self._threads = []
+
+
+    @property
+    def host(self):
+        return self._namenode.server_address[0]
+
+
+    @property
+    def port(self):
+        return self._namenode.server_address[1]
+
+
+    @property
+    def datanode_port(self):
+        return self._datanode.server_address[1]
+
+
+    def start(self):
+        for server in (self._namenode, self._datanode):
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+
+    def stop(self):
+        for server in (self._namenode, self._datanode):
+            server.shutdown()
+            server.server_close()
+
+
+    def reset_counts(self):
+        with self._lock:
+            self.counts = {}
+
+
+    def namenode_requests(self):
+        with self._lock:
+            return sum(n for (node, op), n in self.counts.items()
+                       if node == 'namenode')
+
+
+    ######
+    ######
+    ## Filesystem methods
+    ##
+    ## Direct manipulation of the in-memory tree, used by the request
+    ## handlers and handy for seeding benchmark data.
+
+    def _new_status(self, type_, permission, length=0):
+        now = int(time.time() * 1000)
+        return {'accessTime': now,
+                'blockSize': self.BLOCK_SIZE if type_ == 'FILE' else 0,
+                'group': self.group,
+                'length': length,
+                'modificationTime': now,
+                'owner': self.owner,
+                'pathSuffix': '',
+                'permission': '%o' % int(permission, 8),
+                'replication': 3 if type_ == 'FILE' else 0,
+                'type': type_}
+
+
+    @staticmethod
+    def _parent(path):
+        parent = path.rsplit('/', 1)[0]
+        return parent or '/'
+
+
+    def _children(self, path):
+        prefix = path.rstrip('/') + '/'
+        return sorted(p for p in self._files
+                      if p != '/' and p.startswith(prefix)
+                      and '/' not in p[len(prefix):])
+
+
+    def _touch(self, path):
+        self._files[path]['modificationTime'] = int(time.time() * 1000)
+
+
+    def mkdirs(self, path, permission='755'):
+        with self._lock:
+            parts = [p for p in path.split('/') if p]
+            current = ''
+            for part in parts:
+                current += '/' + part
+                if current not in self._files:
+                    self._files[current] = self._new_status('DIRECTORY',
+                                                            permission)
+                    self._touch(self._parent(current))
+                elif self._files[current]['type'] != 'DIRECTORY':
+                    return False
+            return True
+
+
+    def write_file(self, path, data, permission='644', append=False):
+        with self._lock:
+            self.mkdirs(self._parent(path))
+            if append:
+                data = self._data[path] + data
+            elif path not in self._files:
+                self._files[path] = self._new_status('FILE', permission)
+                self._touch(self._parent(path))
+            self._data[path] = data
+            self._files[path]['length'] = len(data)
+            self._touch(path)
+
+
+    def read_file(self, path):
+        with self._lock:
+            return self._data[path]
+
+
+    def delete(self, path, recursive=False):
+        with self._lock:
+            if path not in self._files:
+                return False
+            children = [p for p in self._files
+                        if p.startswith(path.rstrip('/') + '/')]
+            if children and not recursive:
+                raise _RemoteException(403, 'PathIsNotEmptyDirectoryException',
+                                       '`%s is non empty\': Directory is not '
+                                       'empty' % path)
+            for p in children + [path]:
+                self._files.pop(p, None)
+                self._data.pop(p, None)
+            self._touch(self._parent(path))
+            return True
+
+
+    def rename(self, old, new, overwrite=False):
+        with self._lock:
+            if old not in self._files or self._parent(new) not in self._files:
+                return False
+            if new in self._files:
+                if not overwrite or self._files[new]['type'] == 'DIRECTORY':
+                    return False
+                self.delete(new)
+            moved = [p for p in self._files
+                     if p == old or p.startswith(old + '/')]
+            for p in moved:
+                target = new + p[len(old):]
+                self._files[target] = self._files.pop(p)
+                if p in self._data:
+                    self._data[target] = self._data.pop(p)
+            self._touch(self._parent(old))
+            self._touch(self._parent(new))
+            return True
+
+
+    def status(self, path):
+        with self._lock:
+            if path not in self._files:
+                raise _RemoteException(404, 'FileNotFoundException',
+                                       'File does not exist: %s' % path)
+            return dict(self._files[path])
+
+
+    def listing(self, path, start_after=None, limit=None):
+        '''
+        Returns (statuses, remaining) for the children of path that sort
+        after start_after, at most limit of them.
+        '''
+        with self._lock:
+            status = self.status(path)
+            if status['type'] != 'DIRECTORY':
+                status['pathSuffix'] = ''
+                return [status], 0
+            children = self._children(path)
+            if start_after:
+                prefix = path.rstrip('/') + '/'
+                children = children[bisect.bisect_right(
+                                        children, prefix + start_after):]
+            if limit is None:
+                limit = len(children)
+
+            statuses = []
+            for child in children[:limit]:
+                status = dict(self._files[child])
+                status['pathSuffix'] = child.rsplit('/', 1)[1]
+                statuses.append(status)
+            return statuses, len(children) - len(statuses)
+
+
+class _RemoteException(Exception):
+    def __init__(self, code, exception, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.exception = exception
+        self.message = message
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+    def __init__(self, address, handler, fs):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.fs = fs
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    node = None
+
+    # responses go out in one piece, or keep-alive connections stall on
+    # nagle and delayed acks
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+
+    def log_message(self, format, *args):
+        pass
+
+
+    @property
+    def fs(self):
+        return self.server.fs
+
+
+    def _parse(self):
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path)
+        assert path.startswith('/webhdfs/v1')
+        path = '/' + path[len('/webhdfs/v1'):].strip('/')
+        params = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        return path, params
+
+
+    def _body(self):
+        length = int(self.headers.get('content-length') or 0)
+        chunks = []
+        while length > 0:
+            chunk = self.rfile.read(min(length, 1024 * 1024))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            length -= len(chunk)
+        return ''.join(chunks)
+
+
+    def _throttle(self, nbytes):
+        if self.fs.bandwidth:
+            time.sleep(nbytes / float(self.fs.bandwidth))
+
+
+    def _send(self, code, body='', content_type='application/json',
+              headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self.wfile.flush()
+
+
+    def _send_exception(self, e):
+        self._send(e.code, {'RemoteException': {
+                       'exception': e.exception,
+                       'javaClassName': 'org.apache.hadoop.' + e.exception,
+                       'message': e.message}})
+
+
+    def _dispatch(self):
+        path, params = self._parse()
+        op = params.get('op', '').upper()
+        with self.fs._lock:
+            key = (self.node, op)
+            self.fs.counts[key] = self.fs.counts.get(key, 0) + 1
+        if self.fs.latency:
+            time.sleep(self.fs.latency)
+        try:
+            handler = getattr(self, 'op_%s_%s' % (self.command, op), None)
+            if handler is None:
+                raise _RemoteException(400, 'IllegalArgumentException',
+                                       'Invalid value for webhdfs parameter '
+                                       '"op": No enum constant %s' % op)
+            handler(path, params)
+        except _RemoteException as e:
+            self._send_exception(e)
+
+
+    do_GET = do_PUT = do_POST = do_DELETE = _dispatch
+
+
+class _NamenodeHandler(_Handler):
+    node = 'namenode'
+
+
+    def _dispatch(self):
+        if self.fs.standby:
+            self._body()
+            return self._send_exception(_RemoteException(
+                403, 'StandbyException',
+                'Operation category READ is not supported in state standby'))
+        return _Handler._dispatch(self)
+
+
+    do_GET = do_PUT = do_POST = do_DELETE = _dispatch
+
+
+    def _redirect(self, path, params):
+        self._body()
+        query = urllib.urlencode(params)
+        location = 'http://%s:%s/webhdfs/v1%s?%s' % (
+            self.fs.host, self.fs.datanode_port, urllib.quote(path), query)
+        self._send(307, headers={'Location': location})
+
+
+    def _boolean(self, value):
+        self._send(200, {'boolean': value})
+
+
+    def op_GET_GETFILESTATUS(self, path, params):
+        self._send(200, {'FileStatus': self.fs.status(path)})
+
+
+    def op_GET_LISTSTATUS(self, path, params):
+        statuses, remaining = self.fs.listing(path)
+        self._send(200, {'FileStatuses': {'FileStatus': statuses}})
+
+
+    def op_GET_LISTSTATUS_BATCH(self, path, params):
+        if not self.fs.support_batch:
+            raise _RemoteException(400, 'IllegalArgumentException',
+                                   'Invalid value for webhdfs parameter '
+                                   '"op": No enum constant LISTSTATUS_BATCH')
+        statuses, remaining = self.fs.listing(path, params.get('startAfter'),
+                                              self.fs.batch_size)
+        self._send(200, {'DirectoryListing': {
+                             'partialListing': {
+                                 'FileStatuses': {'FileStatus': statuses}},
+                             'remainingEntries': remaining}})
+
+
+    def op_GET_GETFILECHECKSUM(self, path, params):
+        self.fs.status(path)
+        self._redirect(path, params)
+
+
+    def op_GET_OPEN(self, path, params):
+        self.fs.status(path)
+        self._redirect(path, params)
+
+
+    def op_PUT_CREATE(self, path, params):
+        with self.fs._lock:
+            if (path in self.fs._files
+                    and params.get('overwrite', 'false') != 'true'):
+                self._body()
+                raise _RemoteException(403, 'FileAlreadyExistsException',
+                                       '%s already exists' % path)
+        self._redirect(path, params)
+
+
+    def op_POST_APPEND(self, path, params):
+        self.fs.status(path)
+        self._redirect(path, params)
+
+
+    def op_POST_CONCAT(self, path, params):
+        with self.fs._lock:
+            data = self.fs.read_file(path)
+            sources = params['sources'].split(',')
+            for source in sources:
+                if self.fs._parent(source) != self.fs._parent(path):
+                    raise _RemoteException(
+                        400, 'HadoopIllegalArgumentException',
+                        '%s is not in the same directory as %s'
+                        % (source, path))
+                data += self.fs.read_file(source)
+            for source in sources:
+                self.fs.delete(source)
+            self.fs.write_file(path, data)
+        self._send(200)
+
+
+    def op_PUT_MKDIRS(self, path, params):
+        self._boolean(self.fs.mkdirs(path, params.get('permission', '755')))
+
+
+    def op_PUT_RENAME(self, path, params):
+        overwrite = 'OVERWRITE' in params.get('renameoptions', '')
+        self._boolean(self.fs.rename(path, params['destination'], overwrite))
+
+
+    def op_PUT_SETPERMISSION(self, path, params):
+        with self.fs._lock:
+            self.fs.status(path)
+            permission = params.get('permission', '755')
+            self.fs._files[path]['permission'] = '%o' % int(permission, 8)
+        self._send(200)
+
+
+    def op_PUT_SETOWNER(self, path, params):
+        with self.fs._lock:
+            self.fs.status(path)
+            if params.get('user'):
+                self.fs._files[path]['owner'] = params['user']
+            if params.get('group'):
+                self.fs._files[path]['group'] = params['group']
+        self._send(200)
+
+
+    def op_PUT_SETTIMES(self, path, params):
+        with self.fs._lock:
+            self.fs.status(path)
+            if 'accesstime' in params:
+                self.fs._files[path]['accessTime'] = int(params['accesstime'])
+            if 'modificationtime' in params:
+                self.fs._files[path]['modificationTime'] = int(
+                    params['modificationtime'])
+        self._send(200)
+
+
+    def op_DELETE_DELETE(self, path, params):
+        recursive = params.get('recursive', 'false') == 'true'
+        self._boolean(self.fs.delete(path, recursive))
+
+
+class _DatanodeHandler(_Handler):
+    node = 'datanode'
+
+
+    def op_GET_OPEN(self, path, params):
+        data = self.fs.read_file(path)
+        offset = int(params.get('offset', 0))
+        length = params.get('length')
+        end = len(data) if length is None else offset + int(length)
+        body = data[offset:end]
+        self._throttle(len(body))
+        self._send(200, body, 'application/octet-stream')
+
+
+    def op_GET_GETFILECHECKSUM(self, path, params):
+        data = self.fs.read_file(path)
+        self._send(200, {'FileChecksum': {
+                             'algorithm': 'MD5-of-0MD5-of-512CRC32C',
+                             'bytes': hashlib.md5(data).hexdigest(),
+                             'length': 28}})
+
+
+    def op_PUT_CREATE(self, path, params):
+        data = self._body()
+        self._throttle(len(data))
+        self.fs.write_file(path, data, params.get('permission', '644'))
+        self._send(201, headers={
+            'Location': 'hdfs://%s:%s%s' % (self.fs.host, self.fs.port, path)})
+
+
+    def op_POST_APPEND(self, path, params):
+        data = self._body()
+        self._throttle(len(data))
+        self.fs.write_file(path, data, append=True)
+        self._send(200)
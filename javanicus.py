@@ -36,22 +36,619 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
 
+import bisect
+import collections
+import contextlib
+import ctypes
+import ctypes.util
 import errno
+import fcntl
 import grp
+import hashlib
+import json
 import logging
+import mmap
 import os
 import pwd
+import Queue
+import re
 import shutil
+import signal
 import stat
+import sys
 import tempfile
+import threading
 import time
 import urllib
 import urlparse
+import uuid
 
 import fuse
 import requests
 
 
+if hasattr(os, 'pwrite'):
+    _pwrite = os.pwrite
+else:
+    # os.pwrite only arrived in python 3.3, but libc has always had it
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _libc_pwrite = getattr(_libc, 'pwrite64', _libc.pwrite)
+    _libc_pwrite.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_size_t,
+                             ctypes.c_int64)
+    _libc_pwrite.restype = ctypes.c_ssize_t
+
+    def _pwrite(fd, data, offset):
+        written = _libc_pwrite(fd, data, len(data), offset)
+        if written < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return written
+
+
+def pwrite(fd, data, offset):
+    '''
+    Writes all of data to fd at offset, without using or moving fd's file
+    position, so threads sharing fd needn't take turns seeking it.
+    '''
+    while data:
+        written = _pwrite(fd, data, offset)
+        data = data[written:]
+        offset += written
+
+
+class TTLCache(object):
+    '''
+    A size-bounded, least-recently-used mapping whose entries expire
+    ttl seconds after they're stored.
+    '''
+    def __init__(self, maxsize, ttl):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                expires, value = self._entries.pop(key)
+            except KeyError:
+                return default
+            if expires < time.time():
+                return default
+
+            # re-insert it to mark it as most recently used
+            self._entries[key] = (expires, value)
+            return value
+
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+    def invalidate_prefix(self, path):
+        # drops path and everything below it
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            for key in [k for k in self._entries
+                        if k == path or k.startswith(prefix)]:
+                del(self._entries[key])
+
+
+    def put(self, key, value):
+        if self._maxsize <= 0 or self._ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self._ttl, value)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+class WorkerPool(object):
+    '''
+    A fixed number of daemon threads working through a queue of tasks.
+    '''
+    class Task(object):
+        def __init__(self, function, args):
+            self._function = function
+            self._args = args
+            self._done = threading.Event()
+            self._result = None
+            self._exc_info = None
+
+
+        def run(self):
+            try:
+                self._result = self._function(*self._args)
+            except:
+                self._exc_info = sys.exc_info()
+            finally:
+                self._done.set()
+
+
+        def wait(self):
+            # returns what the task returned, or raises what it raised
+            self._done.wait()
+            if self._exc_info is not None:
+                raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+            return self._result
+
+
+    def __init__(self, name, workers, queue_size=0):
+        self._name = name
+        self._workers = workers
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+
+    def _start(self):
+        # threads are started on first use rather than up front, since fuse
+        # forks when it daemonizes, and threads don't survive a fork
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._work,
+                                          name='%s-%s' % (self._name, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            task.run()
+
+
+    def close(self):
+        # lets queued tasks finish, then stops the threads
+        with self._lock:
+            threads = list(self._threads)
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+
+    def offer(self, function, *args):
+        # like submit, but gives up and returns None if the queue is full
+        if not self._threads:
+            self._start()
+        task = WorkerPool.Task(function, args)
+        try:
+            self._queue.put_nowait(task)
+        except Queue.Full:
+            return None
+        return task
+
+
+    def submit(self, function, *args):
+        if not self._threads:
+            self._start()
+        task = WorkerPool.Task(function, args)
+        self._queue.put(task)
+        return task
+
+
+class Stats(object):
+    '''
+    Always-on performance counters: how many times things happened, how
+    many are in flight right now, and how long timed things took, as a
+    histogram with the latency buckets below.  Cheap enough to update on
+    every operation, and snapshot() returns a copy that's ready for json.
+    '''
+    # upper bounds of the latency histogram buckets, in milliseconds.  the
+    # last bucket of each histogram holds everything slower than that.
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._counters = collections.defaultdict(int)
+        self._in_flight = collections.defaultdict(int)
+        self._timings = {}
+
+
+    def _record(self, name, seconds, error):
+        ms = seconds * 1000
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = {
+                    'count': 0,
+                    'errors': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'histogram': [0] * (len(self.BUCKETS) + 1),
+                }
+            timing['count'] += 1
+            timing['errors'] += int(error)
+            timing['total_ms'] += ms
+            timing['max_ms'] = max(timing['max_ms'], ms)
+            timing['histogram'][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime': time.time() - self._started,
+                'counters': dict(self._counters),
+                'in_flight': dict(self._in_flight),
+                'buckets_ms': list(self.BUCKETS),
+                'latency': dict(
+                    (name, dict(timing, histogram=list(timing['histogram'])))
+                    for name, timing in self._timings.iteritems()),
+            }
+
+
+    @contextlib.contextmanager
+    def timed(self, name, in_flight=None):
+        '''
+        Times the body of the with statement under name, counting it as
+        in flight under in_flight while it runs.
+        '''
+        if in_flight is not None:
+            with self._lock:
+                self._in_flight[in_flight] += 1
+        start = time.time()
+        error = False
+        try:
+            yield
+        except GeneratorExit:
+            # a generator being abandoned isn't it failing
+            raise
+        except:
+            error = True
+            raise
+        finally:
+            self._record(name, time.time() - start, error)
+            if in_flight is not None:
+                with self._lock:
+                    self._in_flight[in_flight] -= 1
+
+
+    def timed_iter(self, name, function, in_flight=None):
+        '''
+        Generates what function() returns, timing the call and iterating
+        over the result together, until that's finished or abandoned, the
+        way timed() would.  Nothing happens until the first item is asked
+        for.
+        '''
+        with self.timed(name, in_flight=in_flight):
+            for item in function():
+                yield item
+
+
+class Tracer(object):
+    '''
+    Records every filesystem operation to a file, one json object per
+    line: the op, its arguments (with written data replaced by its
+    length), when it started (in seconds since the trace did), how long
+    it took in milliseconds, its result or errno, and the WebHDFS
+    requests it made along the way.  A readdir's listing is made as it's
+    iterated, after it's returned, so its line is written once that's
+    done, with the names it listed and how many.  Requests made by
+    background threads (readahead, write-back and so on) get lines of
+    their own, with an op of 'webhdfs'.  replay.py plays traces back.
+    '''
+    FORMAT = 1
+
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._started = time.time()
+        self._write({'format': self.FORMAT, 'started': self._started})
+
+
+    def _write(self, record):
+        line = json.dumps(record, default=repr, separators=(',', ':'))
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line + '\n')
+
+
+    @staticmethod
+    def _summary(op, result):
+        # just enough of what an op returned to play it back later
+        if op == 'getattr' and isinstance(result, dict):
+            return {'size': result.get('st_size'),
+                    'dir': stat.S_ISDIR(result.get('st_mode', 0))}
+        if isinstance(result, basestring):
+            return len(result)
+        if isinstance(result, (int, long)):
+            return result
+        return None
+
+
+    def call(self, op, args, function):
+        '''
+        Calls function(op, *args), recording it as op.
+        '''
+        recorded = args
+        if op == 'write':
+            recorded = (args[0], len(args[1])) + tuple(args[2:])
+        record = {'op': op,
+                  'args': recorded,
+                  'thread': threading.current_thread().name,
+                  'start': time.time() - self._started,
+                  'requests': []}
+        self._local.requests = record['requests']
+        try:
+            result = function(op, *args)
+        except fuse.FuseOSError as e:
+            record['error'] = e.errno
+            raise
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        else:
+            if op == 'readdir' and result is not None:
+                listing, record = self._listing(record, iter(result)), None
+                return listing
+            record['result'] = self._summary(op, result)
+            return result
+        finally:
+            self._local.requests = None
+            if record is not None:
+                self._finish(record)
+
+
+    def _finish(self, record):
+        record['ms'] = (time.time() - self._started - record['start']) * 1000
+        self._write(record)
+
+
+    def _listing(self, record, entries):
+        # generates entries, with the requests made for them recorded
+        # against record, which is finished when whoever's iterating is
+        names = record['entries'] = []
+        try:
+            while True:
+                self._local.requests = record['requests']
+                try:
+                    entry = next(entries)
+                except StopIteration:
+                    return
+                finally:
+                    self._local.requests = None
+                names.append(entry[0] if isinstance(entry, tuple) else entry)
+                yield entry
+        except fuse.FuseOSError as e:
+            record['error'] = e.errno
+            raise
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['result'] = len(names)
+            self._finish(record)
+
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+    def request(self, node, op, start, seconds):
+        '''
+        Records a WebHDFS request to node that started at start, and took
+        seconds, against whichever op this thread is in the middle of.
+        '''
+        request = [node, op, start - self._started, seconds * 1000]
+        requests = getattr(self._local, 'requests', None)
+        if requests is not None:
+            requests.append(request)
+        else:
+            self._write({'op': 'webhdfs',
+                         'thread': threading.current_thread().name,
+                         'start': start - self._started,
+                         'ms': seconds * 1000,
+                         'requests': [request]})
+
+
+class FileRange(object):
+    '''
+    A read-only, file-like view of length bytes of the file at path,
+    starting at start, for uploading part of a file.  It has its own file
+    handle, and a length, so it's streamed with the right Content-Length.
+    '''
+    def __init__(self, path, start, length):
+        self._file = open(path, 'rb')
+        self._file.seek(start)
+        self._length = length
+        self._remaining = length
+
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(WebHDFS.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+    def __len__(self):
+        return self._length
+
+
+    def close(self):
+        self._file.close()
+
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+
+class RequestScheduler(object):
+    '''
+    Hands out slots for requests to be in flight, up to total at once, in
+    lanes that each have a limit of their own.  A request waiting in a
+    lane that comes earlier in limits goes ahead of any waiting in later
+    ones.  How long requests wait for a slot, and how many are waiting,
+    is kept in stats per lane.
+    '''
+    def __init__(self, total, limits, stats):
+        # limits is a list of (lane, limit), highest priority first
+        self._total = total
+        self._lanes = [lane for lane, limit in limits]
+        self._limits = dict(limits)
+        self._active = dict.fromkeys(self._lanes, 0)
+        self._waiting = dict.fromkeys(self._lanes, 0)
+        self._in_use = 0
+        self._lock = threading.Condition()
+        self._stats = stats
+
+
+    def _can_start(self, lane):
+        # call with _lock held
+        if (self._in_use >= self._total
+                or self._active[lane] >= self._limits[lane]):
+            return False
+        for other in self._lanes[:self._lanes.index(lane)]:
+            if (self._waiting[other]
+                    and self._active[other] < self._limits[other]):
+                return False
+        return True
+
+
+    @contextlib.contextmanager
+    def slot(self, lane):
+        '''
+        Waits for a slot in lane, and holds it for the body of the with
+        statement.
+        '''
+        with self._stats.timed('scheduler.%s.wait' % lane,
+                               in_flight='scheduler.%s.queued' % lane):
+            with self._lock:
+                self._waiting[lane] += 1
+                try:
+                    while not self._can_start(lane):
+                        self._lock.wait()
+                finally:
+                    self._waiting[lane] -= 1
+                self._active[lane] += 1
+                self._in_use += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._active[lane] -= 1
+                self._in_use -= 1
+                self._lock.notify_all()
+
+
+class WebHDFSTransport(object):
+    '''
+    Sends WebHDFS's HTTP requests over pools of keep-alive connections,
+    one pool per host.  Requests that move file data and requests for
+    metadata wait for slots in separate lanes of a RequestScheduler, so
+    big transfers can't hold up the small requests people are waiting
+    on.  Also remembers where the namenode redirected recent reads to, so
+    they can go straight to the datanode next time.
+    '''
+    # ops that move file data, everything else is metadata
+    DATA_OPS = ('APPEND', 'CREATE', 'OPEN')
+
+
+    def __init__(self, max_requests, pool_hosts, pool_size, redirect_ttl,
+                 redirect_cache_size=1024, stats=None,
+                 max_data_requests=None, tracer=None):
+        # urllib3's connection pools are thread safe, so one session with
+        # a suitably sized adapter is shared by every thread
+        self._session = requests.session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_hosts,
+                                                pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self.redirects = TTLCache(redirect_cache_size, redirect_ttl)
+        self._stats = stats if stats is not None else Stats()
+        self._tracer = tracer
+
+        # metadata can use every slot, data only as many as it's allowed
+        if max_data_requests is None:
+            max_data_requests = max_requests
+        self._scheduler = RequestScheduler(
+            max_requests, [('metadata', max_requests),
+                           ('data', min(max_data_requests, max_requests))],
+            self._stats)
+
+
+    def _op(self, url, kwargs):
+        # requests to the namenode carry their op in params, the ones to
+        # datanodes go to a location the namenode gave us
+        params = kwargs.get('params')
+        if params:
+            return 'namenode', params.get('op')
+        query = urlparse.urlsplit(url).query
+        return 'datanode', dict(urlparse.parse_qsl(query)).get('op')
+
+
+    @contextlib.contextmanager
+    def _slot(self, url, kwargs):
+        # waits our turn in the op's lane, then times the request itself
+        node, op = self._op(url, kwargs)
+        lane = 'data' if op in self.DATA_OPS else 'metadata'
+        with self._scheduler.slot(lane):
+            with self._stats.timed('%s.%s' % (node, op), in_flight='webhdfs'):
+                start = time.time()
+                try:
+                    yield
+                finally:
+                    if self._tracer is not None:
+                        self._tracer.request(node, op, start,
+                                             time.time() - start)
+
+
+    def close(self):
+        self._session.close()
+        self.redirects.clear()
+
+
+    def request(self, method, url, **kwargs):
+        with self._slot(url, kwargs):
+            return self._session.request(method, url, **kwargs)
+
+
+    @contextlib.contextmanager
+    def stream(self, method, url, **kwargs):
+        # for responses whose body is read a chunk at a time.  we hold our
+        # slot, and the connection, until the caller is done with it.
+        with self._slot(url, kwargs):
+            response = self._session.request(method, url, stream=True,
+                                             **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+
+
 class WebHDFS(object):
     '''
     Abstracts away some basic file operations for a webhdfs server.
@@ -60,16 +657,82 @@ class WebHDFS(object):
     class WebHDFSDirectoryNotEmptyError(WebHDFSError): pass
     class WebHDFSFileNotFoundError(WebHDFSError): pass
     class WebHDFSPermissionError(WebHDFSError): pass
+    class WebHDFSStandbyError(WebHDFSError): pass
+    class WebHDFSUnsupportedOperationError(WebHDFSError): pass
+
+    # file data is streamed to and from the server in pieces of this size
+    CHUNK_SIZE = 64 * 1024
+
+    # default cap on HTTP requests in flight at once, across all threads,
+    # and on how many of those can be moving file data, so there's always
+    # room for metadata requests
+    MAX_REQUESTS = 16
+    MAX_DATA_REQUESTS = 12
 
+    # default number of hosts to keep connection pools for, and of idle
+    # connections to keep open to each of them
+    POOL_HOSTS = 32
+    POOL_SIZE = MAX_REQUESTS
 
-    def __init__(self, host, port, debug=False):
+    # where the namenode sends us to read a file is remembered for this many
+    # seconds, per this many bytes of the file (the default hdfs block size)
+    REDIRECT_TTL = 60.0
+    REDIRECT_SPAN = 128 * 1024 * 1024
+
+
+    def __init__(self, host, port, debug=False, max_requests=MAX_REQUESTS,
+                 pool_hosts=POOL_HOSTS, pool_size=POOL_SIZE,
+                 redirect_ttl=REDIRECT_TTL, stats=None,
+                 max_data_requests=MAX_DATA_REQUESTS, tracer=None):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(logging.DEBUG if debug else logging.INFO)
 
-        self._host = host
-        self._port = port
-        self._base_url = 'http://%s:%s/webhdfs/v1/' % (self._host, self._port)
-        self._session = requests.session()
+        # for HA, host can be a list of namenodes, each as host or host:port.
+        # requests go to whichever of them answered last.
+        hosts = [host] if isinstance(host, basestring) else list(host)
+        self._base_urls = []
+        for namenode in hosts:
+            if ':' not in namenode:
+                namenode = '%s:%s' % (namenode, port)
+            self._base_urls.append('http://%s/webhdfs/v1/' % namenode)
+        self._active = 0
+        self._stats = stats if stats is not None else Stats()
+        self._transport = WebHDFSTransport(
+            max_requests, pool_hosts, pool_size, redirect_ttl,
+            stats=self._stats, max_data_requests=max_data_requests,
+            tracer=tracer)
+
+        # cleared the first time the server turns down LISTSTATUS_BATCH
+        self._batch_listing = True
+
+
+    def _datanode_url(self, location, offset, length):
+        # reuses a datanode location we were redirected to before, with the
+        # range we want this time
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(location)
+        params = [(k, v) for k, v in urlparse.parse_qsl(query)
+                  if k not in ('offset', 'length')]
+        if offset is not None:
+            params.append(('offset', int(offset)))
+        if length is not None:
+            params.append(('length', int(length)))
+        return urlparse.urlunsplit((scheme, netloc, path,
+                                    urllib.urlencode(params), fragment))
+
+
+    def _read_response(self, response, out):
+        # returns the body, or streams it into out and returns its length
+        self._raise_and_log_for_status(response)
+        if out is None:
+            self._stats.count('webhdfs.bytes_read', len(response.content))
+            return response.content
+
+        written = 0
+        for chunk in response.iter_content(self.CHUNK_SIZE):
+            out.write(chunk)
+            written += len(chunk)
+        self._stats.count('webhdfs.bytes_read', written)
+        return written
 
 
     def _raise_and_log_for_status(self, response):
@@ -85,6 +748,19 @@ class WebHDFS(object):
                               response.request.url)
                 elif exception['exception'] == 'AccessControlException':
                     raise WebHDFS.WebHDFSPermissionError(response.request.url)
+                elif exception['exception'].endswith('StandbyException'):
+                    raise WebHDFS.WebHDFSStandbyError(response.request.url)
+            elif e.response.status_code == requests.codes.bad_request:
+                # older servers don't know about newer ops
+                try:
+                    exception = e.response.json()['RemoteException']
+                except (KeyError, ValueError):
+                    exception = {}
+                if (exception.get('exception') ==
+                            'UnsupportedOperationException' or
+                        'No enum constant' in exception.get('message', '')):
+                    raise WebHDFS.WebHDFSUnsupportedOperationError(
+                              response.request.url)
 
             # if we get this far, there's no special handling for this.
             # log it and reraise it.
@@ -96,9 +772,122 @@ class WebHDFS(object):
                                        % (request_line, e, e.response.text))
 
 
-    def _url(self, path):
+    def _is_standby(self, response):
+        if response.status_code != requests.codes.forbidden:
+            return False
+        try:
+            exception = response.json()['RemoteException']['exception']
+        except (KeyError, ValueError):
+            return False
+        return exception.endswith('StandbyException')
+
+
+    def _namenode_request(self, method, path, **kwargs):
+        # tries the namenode that answered last, then the others in turn.
+        # one that's in standby, or that we can't reach, just means moving
+        # on to the next, and the one that answers is where we start next
+        # time.  if none of them will, we're left with the last one's error.
+        active = self._active
+        count = len(self._base_urls)
+        for attempt in range(count):
+            index = (active + attempt) % count
+            last = attempt == count - 1
+            try:
+                response = self._request(method, self._url(path, index),
+                                         **kwargs)
+            except requests.ConnectionError as e:
+                if last:
+                    raise
+                self._logger.warn('Namenode %s is unreachable, trying the '
+                                  'next one: %s', self._base_urls[index], e)
+                continue
+            if not last and self._is_standby(response):
+                self._logger.info('Namenode %s is in standby, trying the '
+                                  'next one', self._base_urls[index])
+                response.close()
+                continue
+
+            if index != active:
+                self._logger.info('Switching to namenode %s',
+                                  self._base_urls[index])
+                self._active = index
+            return response
+
+
+    def _request(self, method, url, **kwargs):
+        return self._transport.request(method, url, **kwargs)
+
+
+    def _send_data(self, method, path, params, data):
+        # the two step dance for uploads: ask the namenode where to send the
+        # data without following its redirect, then send it to that datanode
+        s1_response = self._namenode_request(method, path, params=params,
+                                             allow_redirects=False)
+        self._raise_and_log_for_status(s1_response)
+
+        if 'location' not in s1_response.headers:
+            raise fuse.FuseOSError(errno.EIO)
+        s2_url = s1_response.headers['location']
+
+        if hasattr(data, 'fileno'):
+            length = os.fstat(data.fileno()).st_size - data.tell()
+        else:
+            length = len(data)
+
+        s2_response = self._request(method, s2_url, data=data)
+        self._raise_and_log_for_status(s2_response)
+        self._stats.count('webhdfs.bytes_written', length)
+        return length
+
+
+    def _url(self, path, index):
         # strip the leading / to please urljoin
-        return urlparse.urljoin(self._base_url, path.lstrip('/'))
+        return urlparse.urljoin(self._base_urls[index], path.lstrip('/'))
+
+
+    def append(self, path, data, user=None):
+        '''
+        <post to namenode, don't auto-follow the redirect>
+
+        POST /webhdfs/v1/<PATH>?op=APPEND[&buffersize=<INT>]
+
+        <namenode responds with a redirect to a datanode>
+        HTTP/1.1 307 TEMPORARY_REDIRECT
+        Location: http://<DATANODE>:<PORT>/webhdfs/v1/<PATH>?op=APPEND...
+        Content-Length: 0
+
+        <post to datanode with the data to append>
+        POST /webhdfs/v1/<PATH>?op=APPEND...
+
+        <datanode responds with 200 ok>
+        HTTP/1.1 200 OK
+        Content-Length: 0
+
+        data can be a string or a file object, same as for put().
+        '''
+        params = {'op': 'APPEND'}
+        if user is not None:
+            params['user.name'] = user
+
+        return self._send_data('post', path, params, data)
+
+
+    def concat(self, path, sources, user=None):
+        '''
+        POST /webhdfs/v1/<PATH>?op=CONCAT&sources=<PATHS>
+
+        Appends the sources to path, in order, and removes them.  They have
+        to be in the same directory as path, and all but the last have to
+        be made of full hdfs blocks.
+        '''
+        params = {'op': 'CONCAT',
+                  'sources': ','.join(sources)}
+        if user is not None:
+            params['user.name'] = user
+
+        response = self._namenode_request('post', path, params=params)
+        self._raise_and_log_for_status(response)
+        return 0
 
 
     def checksum(self, path, user=None):
@@ -109,7 +898,7 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.get(self._url(path), params=params)
+        response = self._namenode_request('get', path, params=params)
         self._raise_and_log_for_status(response)
         return response.json()['FileChecksum']
 
@@ -123,7 +912,7 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.put(self._url(path), params=params)
+        response = self._namenode_request('put', path, params=params)
         self._raise_and_log_for_status(response)
         return 0
 
@@ -138,14 +927,13 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.put(self._url(path), params=params)
+        response = self._namenode_request('put', path, params=params)
         self._raise_and_log_for_status(response)
         return 0
 
 
     def close(self):
-        self._session.close()
-        self._session = None
+        self._transport.close()
 
 
     def create(self, path, permissions, user=None):
@@ -168,7 +956,7 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.put(self._url(path), params=params)
+        response = self._namenode_request('put', path, params=params)
         self._raise_and_log_for_status(response)
         return 0
 
@@ -182,27 +970,72 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.delete(self._url(path), params=params)
+        response = self._namenode_request('delete', path, params=params)
         self._raise_and_log_for_status(response)
         if not response.json()['boolean'] == True:
             raise IOError('Error deleting %s: %s' % (path, response.text))
         return 0
 
 
-    def get(self, path, user=None):
+    def get(self, path, offset=None, length=None, out=None, user=None):
         '''
         GET /webhdfs/v1/<PATH>?op=OPEN[&offset=<LONG>][&length=<LONG>]
                                       [&buffersize=<INT>]
 
-        <namenode redirects to datanode, requests will auto-follow>
+        <namenode redirects to datanode>
+        HTTP/1.1 307 TEMPORARY_REDIRECT
+        Location: http://<DATANODE>:<PORT>/webhdfs/v1/<PATH>?op=OPEN...
+
+        <get from datanode>
+        GET /webhdfs/v1/<PATH>?op=OPEN...
+
+        We remember the datanode location for a while, and skip the namenode
+        for reads of the same part of the file until it stops working.
+
+        If out is given, the file data is streamed into it a chunk at a time
+        and the number of bytes written is returned, instead of the data.
         '''
         params = {'op': 'OPEN'}
         if user is not None:
             params['user.name'] = user
-
-        response = self._session.get(self._url(path), params=params)
-        self._raise_and_log_for_status(response)
-        return response.content
+        if offset is not None:
+            params['offset'] = int(offset)
+        if length is not None:
+            params['length'] = int(length)
+
+        # datanodes read files by path, so a stale location still returns
+        # current data.  it just might not be the closest datanode anymore.
+        key = '%s?user=%s&span=%s' % (path, user,
+                                      (offset or 0) // self.REDIRECT_SPAN)
+        location = self._transport.redirects.get(key)
+        self._stats.count('redirect_cache.%s'
+                          % ('misses' if location is None else 'hits'))
+        if location is not None:
+            start = out.tell() if out is not None else None
+            try:
+                with self._transport.stream(
+                        'get', self._datanode_url(location, offset, length)
+                        ) as response:
+                    return self._read_response(response, out)
+            except (requests.RequestException, WebHDFS.WebHDFSError) as e:
+                self._logger.debug('Redirect for %s stopped working, asking '
+                                   'the namenode again: %s', path, e)
+                self._transport.redirects.invalidate(key)
+                if out is not None:
+                    out.seek(start)
+
+        # the namenode's answer is normally a redirect, but anything else is
+        # the answer itself (or an error), and is streamed like one
+        response = self._namenode_request('get', path, params=params,
+                                          allow_redirects=False, stream=True)
+        with contextlib.closing(response):
+            if not response.is_redirect:
+                return self._read_response(response, out)
+            location = response.headers['location']
+
+        self._transport.redirects.put(key, location)
+        with self._transport.stream('get', location) as response:
+            return self._read_response(response, out)
 
 
     def getattr(self, path, user=None):
@@ -213,7 +1046,7 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.get(self._url(path), params=params)
+        response = self._namenode_request('get', path, params=params)
         self._raise_and_log_for_status(response)
         return response.json()['FileStatus']
 
@@ -226,11 +1059,47 @@ class WebHDFS(object):
         if user is not None:
             params['user.name'] = user
 
-        response = self._session.get(self._url(path), params=params)
+        response = self._namenode_request('get', path, params=params)
         self._raise_and_log_for_status(response)
         return response.json()['FileStatuses']['FileStatus']
 
 
+    def list_pages(self, path, user=None):
+        '''
+        GET /webhdfs/v1/<PATH>?op=LISTSTATUS_BATCH[&startAfter=<CHILD>]
+
+        Generates the directory's statuses a page at a time, fetching each
+        page only when it's asked for.  Servers that don't support batched
+        listing get a single page from LISTSTATUS instead.
+        '''
+        params = {'op': 'LISTSTATUS_BATCH'}
+        if user is not None:
+            params['user.name'] = user
+
+        while self._batch_listing:
+            response = self._namenode_request('get', path, params=params)
+            try:
+                self._raise_and_log_for_status(response)
+            except WebHDFS.WebHDFSUnsupportedOperationError:
+                if 'startAfter' in params:
+                    raise
+                self._logger.info('LISTSTATUS_BATCH is not supported, '
+                                  'falling back to LISTSTATUS')
+                self._batch_listing = False
+                break
+
+            listing = response.json()['DirectoryListing']
+            statuses = listing['partialListing']['FileStatuses']['FileStatus']
+            if statuses:
+                yield statuses
+            if not statuses or not listing['remainingEntries']:
+                return
+            params['startAfter'] = statuses[-1]['pathSuffix']
+
+        # the server doesn't do batches
+        yield self.list(path, user=user)
+
+
     def mkdir(self, path, permissions=None, user=None):
         '''
         PUT /webhdfs/v1/<PATH>?op=MKDIRS[&permission=<OCTAL>]
@@ -241,14 +1110,14 @@ class WebHDFS(object):
         if permissions is not None:
             params['permission'] = oct(int(permissions))
 
-        response = self._session.put(self._url(path), params=params)
+        response = self._namenode_request('put', path, params=params)
         self._raise_and_log_for_status(response)
         if not response.json()['boolean']:
             raise fuse.FuseOSError(errno.EREMOTEIO)
         return 0
 
 
-    def put(self, path, data, permissions=None, user=None):
+    def put(self, path, data, permissions=None, blocksize=None, user=None):
         '''
         <put to namenode, don't auto-follow the redirect>
 
@@ -270,37 +1139,34 @@ class WebHDFS(object):
         HTTP/1.1 201 Created
         Location: webhdfs://<HOST>:<PORT>/<PATH>
         Content-Length: 0
+
+        data can be a string, or a file object positioned where the upload
+        should start, which gets streamed to the datanode a chunk at a time.
         '''
-        # append is the same flow as write, but POST with op=APPEND
         params = {'op': 'CREATE',
                   'overwrite': 'true'}
         if user is not None:
             params['user.name'] = user
         if permissions is not None:
             params['permission'] = oct(int(permissions))
+        if blocksize is not None:
+            params['blocksize'] = blocksize
 
-        s1_response = self._session.put(self._url(path), params=params,
-                                        allow_redirects=False)
-        self._raise_and_log_for_status(s1_response)
-
-        if 'location' not in s1_response.headers:
-            raise fuse.FuseOSError(errno.EIO)
-        s2_url = s1_response.headers['location']
-
-        s2_response = self._session.put(s2_url, data=data)
-        self._raise_and_log_for_status(s2_response)
-        return len(data)
+        return self._send_data('put', path, params, data)
 
 
-    def rename(self, old, new, user=None):
+    def rename(self, old, new, overwrite=False, user=None):
         '''
         PUT /webhdfs/v1/<PATH>?op=RENAME&destination=<PATH>
+                                       [&renameoptions=OVERWRITE]
         '''
         params = {'op': 'RENAME',
                   'destination': new}
         if user is not None:
             params['user.name'] = user
-        response = self._session.put(self._url(old), params=params)
+        if overwrite:
+            params['renameoptions'] = 'OVERWRITE'
+        response = self._namenode_request('put', old, params=params)
         self._raise_and_log_for_status(response)
         if not response.json()['boolean']:
             raise fuse.FuseOSError(errno.EREMOTEIO)
@@ -313,11 +1179,332 @@ class WebHDFS(object):
                   'modificationtime': int(mtime) * 1000}
         if user is not None:
             params['user.name'] = user
-        response = self._session.put(self._url(path), params=params)
+        response = self._namenode_request('put', path, params=params)
         self._raise_and_log_for_status(response)
         return 0
 
 
+class IdentityMap(object):
+    '''
+    Maps HDFS users and groups to local uids and gids, and back.
+
+    Answers from the system's user and group databases are cached for ttl
+    seconds, and names or ids they don't know about for negative_ttl, since
+    with LDAP or the like behind them every lookup can mean a trip over the
+    network.  HDFS principals with no local account can be given ids in a
+    map file, with lines like
+
+        user  etl        1500
+        group analytics  2000
+
+    which take precedence over the system databases, in both directions.
+    '''
+    TTL = 300.0
+    NEGATIVE_TTL = 60.0
+    CACHE_SIZE = 10000
+
+    # what unknown users and groups, and unknown ids, map to
+    DEFAULT_ID = 0
+    DEFAULT_NAME = 'root'
+
+
+    def __init__(self, map_file=None, ttl=TTL, negative_ttl=NEGATIVE_TTL,
+                 cache_size=CACHE_SIZE):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._found = TTLCache(cache_size, ttl)
+        self._missing = TTLCache(cache_size, negative_ttl)
+        self._static = {'uid': {}, 'gid': {}, 'user': {}, 'group': {}}
+        if map_file is not None:
+            self._load(map_file)
+
+
+    def _load(self, map_file):
+        with open(map_file) as f:
+            for number, line in enumerate(f, 1):
+                fields = line.split('#', 1)[0].split()
+                if not fields:
+                    continue
+                try:
+                    kind, name, id_ = fields
+                    id_ = int(id_)
+                    if kind not in ('user', 'group'):
+                        raise ValueError(kind)
+                except ValueError:
+                    raise ValueError('%s:%d: expected "user|group <name> <id>"'
+                                     % (map_file, number))
+
+                if kind == 'user':
+                    self._static['uid'][name] = id_
+                    self._static['user'][id_] = name
+                else:
+                    self._static['gid'][name] = id_
+                    self._static['group'][id_] = name
+
+
+    def _lookup(self, kind, key, lookup, default):
+        value = self._static[kind].get(key)
+        if value is not None:
+            return value
+
+        value = self._found.get((kind, key))
+        if value is not None:
+            return value
+        if (kind, key) in self._missing:
+            return default
+
+        try:
+            value = lookup(key)
+        except KeyError:
+            self._logger.debug('No %s found for %s, defaulting to %s',
+                               kind, key, default)
+            self._missing.put((kind, key), True)
+            return default
+        self._found.put((kind, key), value)
+        return value
+
+
+    def clear(self):
+        self._found.clear()
+        self._missing.clear()
+
+
+    def gid(self, group):
+        return self._lookup('gid', group, lambda g: grp.getgrnam(g).gr_gid,
+                            self.DEFAULT_ID)
+
+
+    def group(self, gid):
+        return self._lookup('group', gid, lambda g: grp.getgrgid(g).gr_name,
+                            self.DEFAULT_NAME)
+
+
+    def uid(self, user):
+        return self._lookup('uid', user, lambda u: pwd.getpwnam(u).pw_uid,
+                            self.DEFAULT_ID)
+
+
+    def user(self, uid):
+        return self._lookup('user', uid, lambda u: pwd.getpwuid(u).pw_name,
+                            self.DEFAULT_NAME)
+
+
+class DataCache(object):
+    '''
+    Where the local copies of WebHDFS files live.
+
+    A copy is checked out while a file is open, and checked back in with
+    the server version it matches and which of its blocks are valid when
+    the file is closed.  Checked in copies are kept, least recently used
+    first out, until they'd take up more than max_bytes on disk.  If root
+    is given the cache (and its index) persists across mounts, in a
+    directory of its own under root, otherwise it lives in a temporary
+    directory that's removed on close.
+    '''
+    INDEX = 'index.json'
+    FORMAT = 1
+
+    # root may well be somewhere with other files in it, so the cache keeps
+    # to a directory of its own, and only ever cleans up names it makes
+    DIRECTORY = 'javanicus-cache'
+    NAMES = re.compile(r'^[0-9a-f]{40}(\.open)?$')
+
+    # the index is written at most this often, and when the cache is closed.
+    # copies are renamed while they're checked out, so a stale index never
+    # vouches for a copy that might have been modified since.
+    SAVE_INTERVAL = 5.0
+
+
+    def __init__(self, root=None, max_bytes=0, block_size=None):
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._persistent = root is not None
+        if self._persistent:
+            self._root = os.path.join(os.path.abspath(root), self.DIRECTORY)
+            if not os.path.isdir(self._root):
+                os.makedirs(self._root)
+        else:
+            self._root = tempfile.mkdtemp(prefix='javanicus')
+            max_bytes = 0
+        self._max_bytes = max_bytes
+        self._block_size = block_size
+
+        # path -> {'version', 'remote_size', 'blocks', 'size'}, least
+        # recently used first
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._saved = 0
+        if self._persistent:
+            self._load()
+
+
+    @staticmethod
+    def _name(path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return hashlib.sha1(path).hexdigest()
+
+
+    @staticmethod
+    def _ranges(blocks):
+        # compresses a set of block indexes into [start, end) pairs
+        ranges = []
+        for block in sorted(blocks):
+            if ranges and ranges[-1][1] == block:
+                ranges[-1][1] = block + 1
+            else:
+                ranges.append([block, block + 1])
+        return ranges
+
+
+    def _local_path(self, path, checked_out=False):
+        name = self._name(path)
+        if checked_out:
+            name += '.open'
+        return os.path.join(self._root, name)
+
+
+    def _load(self):
+        index_path = os.path.join(self._root, self.INDEX)
+        try:
+            with open(index_path) as index_fh:
+                index = json.load(index_fh)
+        except (IOError, ValueError) as e:
+            index = {}
+            if os.path.exists(index_path):
+                self._logger.warning('Ignoring unreadable cache index %s: %s',
+                                     index_path, e)
+
+        # copies are only any good with the block size they were made with
+        if (index.get('format') == self.FORMAT
+                and index.get('block_size') == self._block_size):
+            for path, entry in index.get('entries', []):
+                if not os.path.exists(self._local_path(path)):
+                    continue
+                version = entry['version']
+                if isinstance(version, list):
+                    version = tuple(version)
+                blocks = set()
+                for start, end in entry['blocks']:
+                    blocks.update(xrange(start, end))
+                self._entries[path] = {'version': version,
+                                       'remote_size': entry['remote_size'],
+                                       'blocks': blocks,
+                                       'size': entry['size']}
+
+        # anything else in there is left over from a copy that was checked
+        # out when we went away, or that the index doesn't know about
+        known = set(self._name(path) for path in self._entries)
+        for name in os.listdir(self._root):
+            local_path = os.path.join(self._root, name)
+            if (name not in known and os.path.isfile(local_path)
+                    and (self.NAMES.match(name)
+                         or name == self.INDEX + '.tmp')):
+                os.remove(local_path)
+        self._logger.info('Loaded %s cached files (%s bytes) from %s',
+                          len(self._entries), self._total(), self._root)
+
+
+    def _save(self, force=False):
+        # call with the lock held
+        if not self._persistent:
+            return
+        if not force and time.time() - self._saved < self.SAVE_INTERVAL:
+            return
+
+        entries = []
+        for path, entry in self._entries.iteritems():
+            entries.append([path, {'version': entry['version'],
+                                   'remote_size': entry['remote_size'],
+                                   'blocks': self._ranges(entry['blocks']),
+                                   'size': entry['size']}])
+        index = {'format': self.FORMAT,
+                 'block_size': self._block_size,
+                 'entries': entries}
+
+        index_path = os.path.join(self._root, self.INDEX)
+        with open(index_path + '.tmp', 'w') as index_fh:
+            json.dump(index, index_fh)
+        os.rename(index_path + '.tmp', index_path)
+        self._saved = time.time()
+
+
+    def _total(self):
+        return sum(entry['size'] for entry in self._entries.itervalues())
+
+
+    def _evict(self):
+        # call with the lock held.  drops least recently used copies until
+        # we're back under budget.
+        total = self._total()
+        while self._entries and total > self._max_bytes:
+            path, entry = self._entries.popitem(last=False)
+            os.remove(self._local_path(path))
+            total -= entry['size']
+            self._logger.debug('Evicted cached copy of %s (%s bytes)',
+                               path, entry['size'])
+
+
+    def checkin(self, path, state=None):
+        '''
+        Gives back a checked out copy.  state is a dict of the 'version',
+        'remote_size' and 'blocks' it holds, or None if it's not worth
+        keeping (eg. it has changes that never made it to the server).
+        '''
+        local_path = self._local_path(path, checked_out=True)
+        with self._lock:
+            if state is None:
+                os.remove(local_path)
+            else:
+                # sparse files only take up the blocks we actually fetched
+                size = os.stat(local_path).st_blocks * 512
+                os.rename(local_path, self._local_path(path))
+                self._entries[path] = {'version': state['version'],
+                                       'remote_size': state['remote_size'],
+                                       'blocks': set(state['blocks']),
+                                       'size': size}
+                self._evict()
+            self._save()
+
+
+    def checkout(self, path):
+        '''
+        Returns the local path to use for a copy of path, and the state it
+        was checked in with, or None if there's no cached copy of it.
+        '''
+        local_path = self._local_path(path, checked_out=True)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is None:
+                open(local_path, 'wb').close()
+            else:
+                os.rename(self._local_path(path), local_path)
+        return local_path, entry
+
+
+    def close(self):
+        with self._lock:
+            if self._persistent:
+                self._save(force=True)
+            else:
+                shutil.rmtree(self._root)
+
+
+    def discard(self, path, children=False):
+        '''
+        Forgets any cached copy of path, or with children, of anything at
+        or below it.
+        '''
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            if children:
+                paths = [p for p in self._entries
+                         if p == path or p.startswith(prefix)]
+            else:
+                paths = [path] if path in self._entries else []
+            for cached in paths:
+                del(self._entries[cached])
+                os.remove(self._local_path(cached))
+
+
 class Javanicus(fuse.Operations):
     MODE_FLAGS = {
         'DIRECTORY': stat.S_IFDIR,
@@ -325,21 +1512,225 @@ class Javanicus(fuse.Operations):
         'SYMLINK': stat.S_IFLNK,
     }
 
-
-    def __init__(self, host, port, mountpoint='.', debug=True):
+    # local copies are fetched and tracked in chunks of this many bytes
+    BLOCK_SIZE = 1024 * 1024
+
+    # how long, and how many, file statuses to remember
+    ATTR_TIMEOUT = 5.0
+    ATTR_CACHE_SIZE = 20000
+
+    # how long, and how many, paths the server said don't exist to remember.
+    # kept short, since anyone else may create them.
+    NEGATIVE_TIMEOUT = 2.0
+    NEGATIVE_CACHE_SIZE = 10000
+
+    # how local copies are checked against the server ('status' compares
+    # modification time and length, 'checksum' compares GETFILECHECKSUM),
+    # and how many seconds a checked copy is trusted for
+    VALIDATE_MODES = ('status', 'checksum')
+    LEASE = 3.0
+
+    # default byte budget for a persistent cache of local copies
+    CACHE_SIZE = 10 * 1024 * 1024 * 1024
+
+    # sequential reads prefetch this many blocks ahead to start with,
+    # doubling each time the pattern continues up to the max
+    READAHEAD_MIN = 2
+    READAHEAD_MAX = 32
+    READAHEAD_WORKERS = 4
+
+    # runs of at least PARALLEL_THRESHOLD missing bytes are fetched as
+    # ranges of PARALLEL_RANGE bytes (rounded up to whole blocks), this many
+    # at a time
+    PARALLEL_FETCHES = 4
+    PARALLEL_THRESHOLD = 16 * 1024 * 1024
+    PARALLEL_RANGE = 8 * 1024 * 1024
+
+    # full uploads of at least UPLOAD_THRESHOLD bytes are sent as parts of
+    # UPLOAD_PART_SIZE bytes, this many at a time, and put together on the
+    # server.  each part is created with a block size of its own size, so
+    # it has to be one the cluster allows: a multiple of its checksum chunk
+    # (512 bytes), and at least its minimum block size (1MB by default).
+    PARALLEL_UPLOADS = 4
+    UPLOAD_THRESHOLD = 256 * 1024 * 1024
+    UPLOAD_PART_SIZE = 128 * 1024 * 1024
+
+    # with write-back on, closed files are uploaded by this many background
+    # threads.  closing blocks once this many uploads are queued up.
+    UPLOAD_WORKERS = 4
+    UPLOAD_QUEUE = 64
+
+    # a directory of files about the mount itself, which isn't passed on
+    # to the server.  see _control().
+    CONTROL_DIR = '/.javanicus'
+    CONTROL_PAD = 4096
+
+    # paths written to CONTROL_DIR/warm are walked by this many threads
+    WARM_WORKERS = 8
+
+
+    def __init__(self, host, port, mountpoint='.', debug=True,
+                 block_size=BLOCK_SIZE, attr_timeout=ATTR_TIMEOUT,
+                 attr_cache_size=ATTR_CACHE_SIZE,
+                 negative_timeout=NEGATIVE_TIMEOUT,
+                 negative_cache_size=NEGATIVE_CACHE_SIZE, validate='status',
+                 lease=LEASE, cache_dir=None, cache_size=CACHE_SIZE,
+                 readahead_min=READAHEAD_MIN, readahead_max=READAHEAD_MAX,
+                 parallel_fetches=PARALLEL_FETCHES,
+                 parallel_threshold=PARALLEL_THRESHOLD,
+                 parallel_uploads=PARALLEL_UPLOADS,
+                 upload_threshold=UPLOAD_THRESHOLD,
+                 upload_part_size=UPLOAD_PART_SIZE,
+                 writeback=False, upload_workers=UPLOAD_WORKERS,
+                 defer_flush=False, warm_workers=WARM_WORKERS,
+                 id_map=None, trace=None, **hdfs_options):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.setLevel(logging.DEBUG if debug else logging.INFO)
 
-        self._hdfs = WebHDFS(host, port, debug)
+        # any other options are for our WebHDFS client.  with trace, every
+        # operation is recorded there (see Tracer).
+        self._stats = Stats()
+        self._tracer = Tracer(trace) if trace is not None else None
+        self._hdfs = WebHDFS(host, port, debug, stats=self._stats,
+                             tracer=self._tracer, **hdfs_options)
         self._mountpoint = os.path.abspath(mountpoint).rstrip('/')
 
-        self._tmpdir = tempfile.mkdtemp(prefix='javanicus')
+        self._cache = DataCache(cache_dir, cache_size, block_size)
         self._tmpfiles = {}
-
-
-    def __call__(self, *args, **kwargs):
-        self._logger.debug('%s %s', args, kwargs)
-        return super(Javanicus, self).__call__(*args, **kwargs)
+        self._tmpfiles_lock = threading.Lock()
+        self._local = threading.local()
+
+        # what each open file handle is reading, listing state of each open
+        # directory handle (see readdir()), and what each open control file
+        # handle reads and has written.  control files with a writer are
+        # writable, and what's written to them goes to it.
+        self._handles = {}
+        self._dirs = {}
+        self._control_handles = {}
+        self._handles_lock = threading.Lock()
+        self._next_handle = 0
+        self._control_files = {'stats': self._stats_file,
+                               'warm': self._warm_file}
+        self._control_writers = {'warm': self._warm}
+        self._signal_fd = None
+
+        # progress of warming caches (see _warm()), under _warm_lock.  file
+        # contents are only worth fetching into a cache that keeps them.
+        self._warmer = WorkerPool('warm', warm_workers)
+        self._warm_lock = threading.Lock()
+        self._warm_progress = {'pending': 0, 'dirs': 0, 'files': 0,
+                               'bytes': 0, 'errors': 0}
+        self._warm_data = cache_dir is not None
+        self._warm_stopped = False
+
+        self._ids = IdentityMap(id_map)
+        self._block_size = block_size
+        self._attr_cache = TTLCache(attr_cache_size, attr_timeout)
+        self._missing = TTLCache(negative_cache_size, negative_timeout)
+        self._validate = validate
+        self._lease = lease
+
+        self._readahead_min = min(readahead_min, readahead_max)
+        self._readahead_max = readahead_max
+        self._prefetcher = None
+        if readahead_max > 0:
+            self._prefetcher = WorkerPool('prefetch', self.READAHEAD_WORKERS,
+                                          queue_size=4 * readahead_max)
+
+        self._parallel_threshold = parallel_threshold
+        self._fetcher = None
+        if parallel_fetches > 1:
+            self._fetcher = WorkerPool('fetch', parallel_fetches)
+
+        self._upload_threshold = max(upload_threshold, upload_part_size)
+        self._upload_part_size = upload_part_size
+        self._part_uploader = None
+        if parallel_uploads > 1:
+            self._part_uploader = WorkerPool('upload-part', parallel_uploads)
+
+        # path -> event set once its queued upload is done, and path ->
+        # the error its last upload failed with, both under _tmpfiles_lock
+        self._uploader = None
+        self._uploads = {}
+        self._upload_errors = {}
+        if writeback:
+            self._uploader = WorkerPool('upload', upload_workers,
+                                        queue_size=self.UPLOAD_QUEUE)
+
+        # with defer_flush, closing a file (or a dup of one) doesn't upload
+        # it, the last close does.  fsync() still does.
+        self._defer_flush = defer_flush
+
+
+    def __call__(self, op, *args):
+        self._logger.debug('%s %s', op, args)
+        if op == 'readdir':
+            # a listing is paged in from the server as it's iterated, after
+            # we've returned it, so that's timed along with the call
+            return self._stats.timed_iter(
+                'fuse.%s' % op, lambda: self._operation(op, args),
+                in_flight='fuse')
+        with self._stats.timed('fuse.%s' % op, in_flight='fuse'):
+            return self._operation(op, args)
+
+
+    def _operation(self, op, args):
+        if self._tracer is not None:
+            return self._tracer.call(op, args, self._dispatch)
+        return self._dispatch(op, *args)
+
+
+    def _dispatch(self, op, *args):
+        paths = args[:1]
+        if op in ('link', 'rename', 'symlink'):
+            paths = args[:2]
+        if any(self._is_control(path) for path in paths):
+            return self._control(op, *args)
+        return super(Javanicus, self).__call__(op, *args)
+
+
+    def _new_handle(self):
+        with self._handles_lock:
+            self._next_handle += 1
+            return self._next_handle
+
+
+    def _open_handle(self, path):
+        # each open file handle watches its own reads for readahead
+        fh = self._new_handle()
+        with self._handles_lock:
+            self._handles[fh] = {'path': path,
+                                 'readahead': {'next': 0, 'window': 0,
+                                               'until': 0}}
+        return fh
+
+
+    def log_stats_on(self, signum):
+        '''
+        Logs our stats whenever we're sent signum.  Has to be called from
+        the main thread, before mounting.
+        '''
+        # fuse keeps the main thread busy in C, where python signal handlers
+        # never get to run.  the signal still writes to a wakeup pipe, though,
+        # and a thread of our own (started by init()) watches that.
+        read_fd, write_fd = os.pipe()
+        flags = fcntl.fcntl(write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(write_fd)
+        signal.signal(signum, lambda signum, frame: None)
+        self._signal_fd = read_fd
+
+
+    def _log_stats_on_wakeup(self):
+        while True:
+            try:
+                os.read(self._signal_fd, 1)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            self._logger.info('Stats: %s', json.dumps(self._stats.snapshot(),
+                                                      sort_keys=True))
 
 
     ######
@@ -349,119 +1740,829 @@ class Javanicus(fuse.Operations):
     ## Methods related to creating, updating, and deleting local copies of files
     ##
     ## TODO: refactor these out into a separate class
-    def _tmp_path(self, path):
-        tmp_path = os.path.join(self._tmpdir, path.lstrip('/'))
-        tmp_path_dirname = os.path.dirname(tmp_path)
-        if not os.path.isdir(tmp_path_dirname):
-            os.makedirs(tmp_path_dirname)
-        return tmp_path
-
-
     def _open_tmpfile(self, path):
-        tmp_path = self._tmp_path(path)
-        tmp_fh = open(tmp_path, 'w+b')
-        self._tmpfiles[path] = {'fh': tmp_fh,
-                                'path': tmp_path,
-                                'cksum': '',
-                                'dirty': False}
-        self._logger.debug('Opened temp copy %s of WebHDFS file %s',
-                           tmp_path, path)
-        return tmp_fh
+        # every handle open on a path shares one local copy, which is
+        # counted in 'refs' and only goes away with the last of them (see
+        # _remove_tmpfile()).  local copies are unbuffered, since blocks get
+        # fetched into them through other file handles.  'lock' guards
+        # everything in here, and gets notified whenever fetching some
+        # blocks finishes.  'partial' maps blocks we've written the start
+        # of, but never fetched, to how far into them our writes reach.
+        # 'generation' counts changes to the copy, and 'pushed' is the
+        # generation the server last got, so it's dirty while they differ.
+        # 'view' is a read-only mapping of the copy (see _read_tmpfile()).
+        with self._tmpfiles_lock:
+            if path in self._tmpfiles:
+                tmpfile = self._tmpfiles[path]
+                tmpfile['refs'] += 1
+                return tmpfile
+            tmp_path, cached = self._cache.checkout(path)
+            self._stats.count('data_cache.%s'
+                              % ('misses' if cached is None else 'hits'))
+            tmp_fh = open(tmp_path, 'r+b', 0)
+            tmpfile = {'fh': tmp_fh,
+                       'path': tmp_path,
+                       'lock': threading.Condition(),
+                       'version': None,
+                       'validated': 0,
+                       'generation': 0,
+                       'pushed': 0,
+                       'dirty_from': None,
+                       'blocks': set(),
+                       'partial': {},
+                       'pending': set(),
+                       'remote_size': 0,
+                       'closed': False,
+                       'view': None,
+                       'refs': 1}
+
+            # a cached copy still gets checked against the server before
+            # we use any of it, since it was never validated
+            if cached is not None:
+                tmpfile['version'] = cached['version']
+                tmpfile['blocks'] = cached['blocks']
+                tmpfile['remote_size'] = cached['remote_size']
+            self._tmpfiles[path] = tmpfile
+        self._logger.debug('Opened temp copy %s of WebHDFS file %s%s',
+                           tmp_path, path,
+                           ' from cache' if cached is not None else '')
+        return tmpfile
+
+
+    def _blocks(self, offset, size):
+        # indexes of the blocks covering size bytes starting at offset
+        if size <= 0:
+            return []
+        return range(offset // self._block_size,
+                     (offset + size - 1) // self._block_size + 1)
+
+
+    def _missing_blocks(self, tmpfile, offset, size):
+        # blocks in the given range that don't hold the server's data yet.
+        # nothing past the length the server had when we last synced needs
+        # fetching.  call with tmpfile['lock'] held.
+        return [b for b in self._blocks(offset, size)
+                if b not in tmpfile['blocks']
+                and b * self._block_size < tmpfile['remote_size']]
+
+
+    def _wait_for_pending(self, tmpfile, offset=0, size=None):
+        # waits out any fetches into the given range (or the whole file), so
+        # they can't land on top of what we're about to do to it.  call with
+        # tmpfile['lock'] held.
+        while True:
+            if size is None:
+                pending = tmpfile['pending']
+            else:
+                pending = tmpfile['pending'].intersection(
+                    self._blocks(offset, size))
+            if not pending:
+                return
+            tmpfile['lock'].wait()
+
+
+    def _fetch_blocks(self, path, offset, size, tmpfile=None):
+        # makes sure the blocks of our local copy that cover the given range
+        # hold the server's data, fetching any that don't yet.  blocks are
+        # claimed while they're being fetched, so concurrent readers wait on
+        # each other instead of fetching the same data twice, and the
+        # download itself happens without holding the lock.  background
+        # threads pass in the tmpfile they're working on, since it may have
+        # been released by the time they get to it.
+        if tmpfile is None:
+            tmpfile = self._tmpfiles[path]
+        user = self._current_user
+        while True:
+            with tmpfile['lock']:
+                missing = self._missing_blocks(tmpfile, offset, size)
+                if not missing or tmpfile['closed']:
+                    return
+                claimed = [b for b in missing if b not in tmpfile['pending']]
+                if not claimed:
+                    tmpfile['lock'].wait()
+                    continue
+                tmpfile['pending'].update(claimed)
+                remote_size = tmpfile['remote_size']
+                partial = dict((b, tmpfile['partial'][b]) for b in claimed
+                               if b in tmpfile['partial'])
+
+            # fetch contiguous runs of claimed blocks with one request each,
+            # except that big runs are split into ranges that are fetched
+            # side by side, from whichever datanodes hold them.  a block
+            # we've already written the start of starts a run of its own,
+            # fetched from where our writes end.
+            runs = []
+            for block in claimed:
+                if (runs and runs[-1][-1] == block - 1
+                        and block not in partial):
+                    runs[-1].append(block)
+                else:
+                    runs.append([block])
+
+            bs = self._block_size
+            step = max(self.PARALLEL_RANGE // bs, 1) * bs
+            ranges = []
+            parallel_ranges = []
+            for run in runs:
+                start = partial.get(run[0], run[0] * bs)
+                end = min((run[-1] + 1) * bs, remote_size)
+                if (self._fetcher is None
+                        or end - start < self._parallel_threshold):
+                    ranges.append((start, end))
+                else:
+                    parallel_ranges.extend(
+                        (max(s, start), min(s + step, end))
+                        for s in range(run[0] * bs, end, step))
+
+            # the workers only download.  our caller may be holding the lock,
+            # so it's up to this thread to mark what they fetched as valid,
+            # as each of them finishes.  ranges we handed out keep their
+            # claims until then.
+            tasks = []
+            failed = None
+            try:
+                for start, end in parallel_ranges:
+                    tasks.append(self._fetcher.submit(
+                        self._fetch_range, path, tmpfile, start, end, user))
+                for start, end in ranges:
+                    self._mark_fetched(tmpfile, self._fetch_range(
+                        path, tmpfile, start, end, user))
+            finally:
+                for task in tasks:
+                    try:
+                        self._mark_fetched(tmpfile, task.wait())
+                    except Exception:
+                        failed = failed or sys.exc_info()
+                with tmpfile['lock']:
+                    tmpfile['pending'].difference_update(claimed)
+                    tmpfile['lock'].notify_all()
+            if failed is not None:
+                raise failed[0], failed[1], failed[2]
+
+
+    def _fetch_range(self, path, tmpfile, start, end, user):
+        # fetches one block aligned range into our local copy, and returns
+        # the blocks it covered.  the range may start partway into its first
+        # block, if we've written the start of it, and our writes may even
+        # reach the end of what the server has.
+        blocks = range(start // self._block_size,
+                       max(end - 1, start) // self._block_size + 1)
+        if start >= end:
+            return blocks
+        with open(tmpfile['path'], 'r+b', 0) as out:
+            out.seek(start)
+            length = self._hdfs.get(path, offset=start, length=end - start,
+                                    out=out, user=user)
+        self._logger.debug('Fetched blocks %s-%s (%s bytes) of %s',
+                           blocks[0], blocks[-1], length, path)
+        return blocks
+
+
+    def _mark_fetched(self, tmpfile, blocks):
+        # lets anyone waiting on these blocks know they're here
+        with tmpfile['lock']:
+            tmpfile['pending'].difference_update(blocks)
+            tmpfile['blocks'].update(blocks)
+            for block in blocks:
+                tmpfile['partial'].pop(block, None)
+            tmpfile['lock'].notify_all()
+
+
+    def _readahead(self, path, fh, offset, size):
+        # watches each handle for sequential reads, and prefetches the
+        # blocks after them in the background.  the window grows while the
+        # pattern holds and is dropped as soon as it doesn't.
+        if self._prefetcher is None:
+            return
+        with self._handles_lock:
+            handle = self._handles.get(fh)
+        if handle is None:
+            return
+        tmpfile = self._tmpfiles[path]
+        with tmpfile['lock']:
+            state = handle['readahead']
+            # the kernel may hand us a sequential stream slightly out of
+            # order when we're multithreaded, so allow a little slop
+            if abs(offset - state['next']) <= self._block_size:
+                state['window'] = max(self._readahead_min,
+                                      min(state['window'] * 2,
+                                          self._readahead_max))
+            else:
+                state['window'] = 0
+                state['until'] = 0
+            state['next'] = offset + size
+            if not state['window']:
+                return
+
+            first = max(state['until'], (offset + size) // self._block_size)
+            last = (offset + size - 1) // self._block_size + state['window']
+            state['until'] = max(state['until'], last + 1)
+            bs = self._block_size
+            blocks = [b for b in range(first, last + 1)
+                      if b not in tmpfile['pending']
+                      and self._missing_blocks(tmpfile, b * bs, 1)]
+
+        user = self._current_user
+        for block in blocks:
+            if self._prefetcher.offer(self._prefetch, path, tmpfile,
+                                      block, user) is None:
+                break
+
+
+    def _prefetch(self, path, tmpfile, block, user):
+        try:
+            with self._acting_as(user):
+                self._fetch_blocks(path, block * self._block_size,
+                                   self._block_size, tmpfile=tmpfile)
+        except Exception as e:
+            self._logger.debug('Prefetching block %s of %s failed: %s',
+                               block, path, e)
+
+
+    def _mark_tmpfile_dirty(self, path, offset):
+        # offset is where the modification starts.  we only need to remember
+        # the lowest one, to know if the server's bytes are still intact.
+        tmpfile = self._tmpfiles[path]
+        if tmpfile['dirty_from'] is None or offset < tmpfile['dirty_from']:
+            tmpfile['dirty_from'] = offset
+        tmpfile['generation'] += 1
+
+
+    def _tmpfile_dirty(self, path):
+        tmpfile = self._tmpfiles[path]
+        return tmpfile['generation'] != tmpfile['pushed']
+
+
+    def _append_tmpfile(self, path, length):
+        # sends just the bytes past what the server has.  returns False if
+        # the server wouldn't take an append, so we can fall back to a full
+        # upload.
+        tmpfile = self._tmpfiles[path]
+        if length > tmpfile['remote_size']:
+            tmp_fh = tmpfile['fh']
+            tmp_fh.seek(tmpfile['remote_size'])
+            try:
+                appended = self._hdfs.append(path, tmp_fh,
+                                             user=self._current_user)
+            except (WebHDFS.WebHDFSFileNotFoundError,
+                    WebHDFS.WebHDFSPermissionError):
+                raise
+            except WebHDFS.WebHDFSError as e:
+                self._logger.warning('Append to %s failed, uploading the '
+                                     'full file instead: %s', path, e)
+                return False
+            self._logger.debug('Appended %s bytes to WebHDFS copy of %s',
+                               appended, path)
+        return True
 
 
     def _push_tmpfile_if_dirty(self, path):
-        if self._tmpfiles[path]['dirty']:
-            tmp_fh = self._tmpfiles[path]['fh']
-            tmp_fh.seek(0)
-            full_data = tmp_fh.read()
-            self._hdfs.put(path, full_data, user=self._current_user)
-            self._logger.debug(
-                'Wrote full file (%s bytes) to WebHDFS copy of %s',
-                len(full_data), path)
-            self._tmpfiles[path]['dirty'] = False
-            self._set_tmpfile_cksum(path)
+        # holds the lock for the whole upload, so nobody moves the file
+        # position out from under it or changes the data mid-upload
+        tmpfile = self._tmpfiles[path]
+        with tmpfile['lock']:
+            if not self._tmpfile_dirty(path):
+                return
+
+            tmp_fh = tmpfile['fh']
+            length = os.fstat(tmp_fh.fileno()).st_size
+
+            # if everything we changed is past the end of the file the
+            # server has, we append, however much that is, since anything
+            # else means sending (and first fetching) what the server
+            # already has.  otherwise (or if the server has nothing, or we
+            # never found out what it has) we upload the full file, so fill
+            # in any gaps first.
+            appended = (tmpfile['version'] is not None
+                        and 0 < tmpfile['remote_size'] <= tmpfile['dirty_from']
+                        and self._append_tmpfile(path, length))
+            if not appended:
+                self._fetch_blocks(path, 0, tmpfile['remote_size'])
+                if not (self._part_uploader is not None
+                        and length >= self._upload_threshold
+                        and self._put_parts(path, tmpfile, length)):
+                    tmp_fh.seek(0)
+                    length = self._hdfs.put(path, tmp_fh,
+                                            user=self._current_user)
+                self._logger.debug(
+                    'Wrote full file (%s bytes) to WebHDFS copy of %s',
+                    length, path)
+
+            self._invalidate_status(path)
+            tmpfile['pushed'] = tmpfile['generation']
+            tmpfile['dirty_from'] = None
+            if appended:
+                # only the blocks we appended whole are known to match the
+                # server now.  blocks before them we never fetched are still
+                # holes, and so is the one the old end fell in, unless it
+                # was already valid.
+                bs = self._block_size
+                start = -(-tmpfile['remote_size'] // bs) * bs
+                tmpfile['blocks'].update(self._blocks(start, length - start))
+            else:
+                tmpfile['blocks'] = set(self._blocks(0, length))
+                tmpfile['partial'] = {}
+            tmpfile['remote_size'] = length
+            self._set_tmpfile_version(path)
+
+
+    def _put_parts(self, path, tmpfile, length):
+        # uploads the local copy as parts, side by side, to hidden files
+        # next to path.  then the first part gets the rest concatenated onto
+        # it and is renamed over path, so nobody ever sees a partial file.
+        # if anything goes wrong, whatever parts made it are cleaned up, and
+        # we return False so the file can be sent whole instead.
+        user = self._current_user
+        directory, name = os.path.split(path)
+        prefix = os.path.join(directory, '.%s.%s.part' % (name,
+                                                          uuid.uuid4().hex))
+        parts = [(prefix + str(i), start,
+                  min(start + self._upload_part_size, length) - start)
+                 for i, start in enumerate(xrange(0, length,
+                                                  self._upload_part_size))]
+
+        try:
+            tasks = [self._part_uploader.submit(self._put_part, part, tmpfile,
+                                                start, size, user)
+                     for part, start, size in parts]
+            failed = None
+            for task in tasks:
+                try:
+                    task.wait()
+                except Exception:
+                    failed = failed or sys.exc_info()
+            if failed is not None:
+                raise failed[0], failed[1], failed[2]
+
+            target = parts[0][0]
+            sources = [part for part, start, size in parts[1:]]
+            if sources:
+                self._hdfs.concat(target, sources, user=user)
+            self._hdfs.rename(target, path, overwrite=True, user=user)
+        except:
+            exc_info = sys.exc_info()
+            for part, start, size in parts:
+                try:
+                    self._hdfs.delete(part, user=user)
+                except (IOError, requests.RequestException) as e:
+                    self._logger.debug('Cleaning up %s: %s', part, e)
+            if (isinstance(exc_info[1], (WebHDFS.WebHDFSFileNotFoundError,
+                                         WebHDFS.WebHDFSPermissionError))
+                    or not isinstance(exc_info[1],
+                                      (IOError, requests.RequestException))):
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._logger.warning('Uploading %s in parts failed, uploading it '
+                                 'whole instead: %s', path, exc_info[1])
+            return False
+        self._invalidate_status(path, parent=True)
+        return True
+
+
+    def _put_part(self, part, tmpfile, start, size, user):
+        with contextlib.closing(FileRange(tmpfile['path'], start,
+                                          size)) as data:
+            # parts have to be whole blocks for CONCAT, whatever the
+            # cluster's default block size is
+            self._hdfs.put(part, data, blocksize=self._upload_part_size,
+                           user=user)
+        self._logger.debug('Wrote %s bytes at %s as %s', size, start, part)
 
 
     def _refresh_tmpfile(self, path):
-        # verifies our local copy vs. webhdfs, fetches new local copy as needed
-        cksum = self._hdfs.checksum(path, user=self._current_user)['bytes']
-        if cksum != self._tmpfiles[path]['cksum']:
+        # verifies our local copy vs. webhdfs, tosses the local copy as
+        # needed.  we trust a copy we've verified for the length of a lease.
+        tmpfile = self._tmpfiles[path]
+        with tmpfile['lock']:
+            if time.time() - tmpfile['validated'] < self._lease:
+                return
+
+            version, hdfs_status = self._remote_version(path)
+            tmpfile['validated'] = time.time()
+            if version == tmpfile['version']:
+                return
+
             # the server always wins
-            self._tmpfiles[path]['dirty'] = False
+            tmpfile['pushed'] = tmpfile['generation']
+            tmpfile['dirty_from'] = None
 
-            # get the new one
+            # toss what we have, blocks get fetched again as they're needed
             self._logger.debug(
-                'Tossing temp copy of %s because checksum changed'
+                'Tossing temp copy of %s because version changed'
                 ' from \'%s\' to \'%s\'',
-                path, self._tmpfiles[path]['cksum'], cksum)
-            tmp_fh = self._tmpfiles[path]['fh']
-            tmp_fh.seek(0)
-            tmp_fh.write(self._hdfs.get(path, user=self._current_user))
-
-            # be paranoid, assume the cksum may have changed.  this doesn't
-            # completely protect us, but in the absence of something better...
-            self._set_tmpfile_cksum(path)
+                path, tmpfile['version'], version)
+            if hdfs_status is None:
+                hdfs_status = self._hdfs.getattr(path,
+                                                 user=self._current_user)
+                self._attr_cache.put(path, hdfs_status)
+            self._wait_for_pending(tmpfile)
+            tmpfile['blocks'] = set()
+            tmpfile['partial'] = {}
+            tmpfile['remote_size'] = hdfs_status['length']
+            tmpfile['fh'].truncate(hdfs_status['length'])
+            tmpfile['version'] = version
 
 
     def _remove_tmpfile(self, path):
-        tmp_fh = self._tmpfiles[path]['fh']
-        tmp_fh.close()
-        tmp_path = self._tmpfiles[path]['path']
-        os.remove(tmp_path)
-        del(self._tmpfiles[path])
+        # drops a reference to the local copy.  the last one hands it back
+        # to the cache, unless it holds changes the server never got.
+        with self._tmpfiles_lock:
+            tmpfile = self._tmpfiles[path]
+            tmpfile['refs'] -= 1
+            if tmpfile['refs']:
+                return
+            del(self._tmpfiles[path])
+        with tmpfile['lock']:
+            # stops any prefetching into it
+            tmpfile['closed'] = True
+            self._wait_for_pending(tmpfile)
+            if tmpfile['view'] is not None:
+                tmpfile['view'].close()
+                tmpfile['view'] = None
+        tmpfile['fh'].close()
+        if (tmpfile['generation'] != tmpfile['pushed']
+                or tmpfile['version'] is None):
+            self._cache.checkin(path)
+        else:
+            self._cache.checkin(path, tmpfile)
+
+
+    def _read_tmpfile(self, tmpfile, offset, size):
+        # reads come straight out of a shared mapping of the local copy,
+        # which costs one copy of the data and no seeking.  the copy's size
+        # changes as it's written, fetched into and truncated, so the
+        # mapping is redone to match it when it's read, and it's only read
+        # with the lock held, so nothing can truncate it out from under us.
+        # call with tmpfile['lock'] held.
+        fd = tmpfile['fh'].fileno()
+        length = os.fstat(fd).st_size
+        view = tmpfile['view']
+        if view is None or len(view) != length:
+            if view is not None:
+                view.close()
+            view = None
+            if length:
+                view = mmap.mmap(fd, length, access=mmap.ACCESS_READ)
+            tmpfile['view'] = view
+        if view is None:
+            return ''
+        return view[offset:offset + size]
+
+
+    def _remote_version(self, path):
+        # returns something that changes whenever the file on the server
+        # does, along with the file's status if we had to fetch it anyway.
+        # checksums are exact but make the datanodes read every block of
+        # the file, the modification time and length are nearly free.
+        if self._validate == 'checksum':
+            cksum = self._hdfs.checksum(path, user=self._current_user)
+            return cksum['bytes'], None
+
+        hdfs_status = self._hdfs.getattr(path, user=self._current_user)
+        self._attr_cache.put(path, hdfs_status)
+        return ((hdfs_status['modificationTime'], hdfs_status['length']),
+                hdfs_status)
+
+
+    def _wait_for_upload(self, path, children=False, check=True):
+        # waits out queued write-back uploads of path (or with children,
+        # anything at or below it).  with check, also raises EIO if the last
+        # upload of path failed, so the failure shows up somewhere besides
+        # the logs.
+        prefix = path.rstrip('/') + '/'
+        with self._tmpfiles_lock:
+            uploads = [done for p, done in self._uploads.iteritems()
+                       if p == path or (children and p.startswith(prefix))]
+        for done in uploads:
+            done.wait()
+
+        if check:
+            with self._tmpfiles_lock:
+                error = self._upload_errors.pop(path, None)
+            if error is not None:
+                raise fuse.FuseOSError(errno.EIO)
+
+
+    def _writeback(self, path, user, done):
+        # runs on the uploader pool, finishing what release() started
+        try:
+            with self._acting_as(user):
+                self._push_tmpfile_if_dirty(path)
+        except Exception as e:
+            self._logger.error('Write-back of %s failed, local changes to it '
+                               'are lost: %s', path, e)
+            with self._tmpfiles_lock:
+                self._upload_errors[path] = e
+        finally:
+            self._remove_tmpfile(path)
+            with self._tmpfiles_lock:
+                if self._uploads.get(path) is done:
+                    del(self._uploads[path])
+            done.set()
+
+
+    def _set_tmpfile_version(self, path):
+        version, _ = self._remote_version(path)
+        with self._tmpfiles[path]['lock']:
+            self._tmpfiles[path]['version'] = version
+            self._tmpfiles[path]['validated'] = time.time()
 
 
-    def _set_tmpfile_cksum(self, path):
-        cksum = self._hdfs.checksum(path, user=self._current_user)['bytes']
-        self._tmpfiles[path]['cksum'] = cksum
+    ######
+    ######
+    ## File status cache methods
+    ##
+    ## Remembers the FileStatus of recently seen paths, so that stat storms
+    ## (ls -l, access checks, kernel lookups) don't each cost a namenode RPC.
+    def _dir_entries(self, path, state, offset):
+        # generates a directory's entries from offset on.  only the page of
+        # the listing that offset falls in is kept around, and going back
+        # before it (say, a rewinddir()) starts the listing over.
+        if offset < 1:
+            yield ('.', None, 1)
+        if offset < 2:
+            yield ('..', None, 2)
+        offset = max(offset - 2, 0)
+
+        if state['pages'] is None or offset < state['start']:
+            state['pages'] = self._hdfs.list_pages(path,
+                                                   user=self._current_user)
+            state['page'] = []
+            state['start'] = 0
+
+        while True:
+            page, start = state['page'], state['start']
+            for i in xrange(max(offset - start, 0), len(page)):
+                yield (page[i]['pathSuffix'], None, start + i + 3)
+            offset = max(offset, start + len(page))
+
+            try:
+                statuses = next(state['pages'])
+            except StopIteration:
+                return
+
+            # we just got these children's statuses for free, so remember
+            # them
+            for hdfs_status in statuses:
+                if hdfs_status['pathSuffix']:
+                    self._attr_cache.put(
+                        os.path.join(path, hdfs_status['pathSuffix']),
+                        hdfs_status)
+            state['page'] = statuses
+            state['start'] = start + len(page)
+
+
+    def _hdfs_status(self, path):
+        # paths that turned out not to exist are remembered too, since
+        # they get probed for over and over (by shells searching PATH,
+        # python importing, and so on)
+        hdfs_status = self._attr_cache.get(path)
+        if hdfs_status is not None:
+            self._stats.count('attr_cache.hits')
+            return hdfs_status
+        if path in self._missing:
+            self._stats.count('negative_cache.hits')
+            raise WebHDFS.WebHDFSFileNotFoundError(path)
+
+        self._stats.count('attr_cache.misses')
+        try:
+            hdfs_status = self._hdfs.getattr(path, user=self._current_user)
+        except WebHDFS.WebHDFSFileNotFoundError:
+            self._missing.put(path, True)
+            raise
+        self._attr_cache.put(path, hdfs_status)
+        return hdfs_status
+
+
+    def _invalidate_status(self, path, parent=False, children=False):
+        # parent is for ops that change the parent directory's mtime,
+        # children is for ops that move or remove a whole directory (or
+        # move one into place).  anything that might have created path
+        # passes through here, so it's no longer known to be missing.
+        if children:
+            self._attr_cache.invalidate_prefix(path)
+            self._missing.invalidate_prefix(path)
+        else:
+            self._attr_cache.invalidate(path)
+            self._missing.invalidate(path)
+        if parent:
+            self._attr_cache.invalidate(os.path.dirname(path))
 
 
     ######
     ######
-    ## UID<->user, GID<->group lookup methods.
+    ## Control file methods
     ##
-    ## TODO: memoize
+    ## Everything under CONTROL_DIR is answered by _control() instead of
+    ## the usual operations.  The files are generated when they're opened,
+    ## and padded out with whitespace so their size doesn't change with
+    ## every getattr.
 
-    def _gid(self, group):
-        try:
-            return grp.getgrnam(group).gr_gid
-        except KeyError:
-            self._logger.debug('No gid found for group %s, defaulting to 0',
-                               group)
+    def _is_control(self, path):
+        return (path == self.CONTROL_DIR
+                or path.startswith(self.CONTROL_DIR + '/'))
+
+
+    def _control(self, op, path, *args):
+        name = path[len(self.CONTROL_DIR) + 1:]
+        if path != self.CONTROL_DIR and name not in self._control_files:
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        if op == 'getattr':
+            now = time.time()
+            status = {'st_atime': now,
+                      'st_ctime': now,
+                      'st_gid': os.getgid(),
+                      'st_mtime': now,
+                      'st_uid': os.getuid()}
+            if path == self.CONTROL_DIR:
+                status.update(st_mode=stat.S_IFDIR | 0555, st_nlink=2)
+            else:
+                mode = 0644 if name in self._control_writers else 0444
+                status.update(st_mode=stat.S_IFREG | mode, st_nlink=1,
+                              st_size=len(self._control_files[name]()))
+            return status
+        elif op == 'access':
+            if args[0] & os.W_OK and name not in self._control_writers:
+                raise fuse.FuseOSError(errno.EACCES)
+            return 0
+        elif op == 'readdir':
+            names = ['.', '..'] + sorted(self._control_files)
+            if len(args) < 2 or args[1] is None:
+                return names
+            return [(n, None, i + 1) for i, n in enumerate(names)
+                    if i >= args[1]]
+        elif op == 'open':
+            if (args[0] & (os.O_WRONLY | os.O_RDWR)
+                    and name not in self._control_writers):
+                raise fuse.FuseOSError(errno.EACCES)
+            fh = self._new_handle()
+            data = self._control_files[name]()
+            with self._handles_lock:
+                self._control_handles[fh] = {'data': data, 'written': []}
+            return fh
+        elif op == 'read':
+            size, offset, fh = args
+            with self._handles_lock:
+                handle = self._control_handles.get(fh)
+            if handle is None:
+                return ''
+            return handle['data'][offset:offset + size]
+        elif op == 'write':
+            # whatever's written is handed over in one piece on flush, so
+            # any trouble with it comes back from close()
+            data, offset, fh = args
+            with self._handles_lock:
+                self._control_handles[fh]['written'].append(data)
+            return len(data)
+        elif op == 'flush':
+            with self._handles_lock:
+                handle = self._control_handles.get(args[0])
+                written = ''.join(handle['written']) if handle else ''
+                if handle:
+                    handle['written'] = []
+            if written:
+                self._control_writers[name](written)
+            return 0
+        elif op == 'truncate':
+            if name not in self._control_writers:
+                raise fuse.FuseOSError(errno.EACCES)
+            return 0
+        elif op == 'release':
+            with self._handles_lock:
+                self._control_handles.pop(args[0], None)
             return 0
+        elif op in ('opendir', 'releasedir'):
+            return 0
+        raise fuse.FuseOSError(errno.EACCES)
 
 
-    def _group(self, gid):
-        try:
-            return grp.getgrgid(gid).gr_name
-        except KeyError:
-            self._logger.debug('No group found for gid %s, defaulting to root',
-                               gid)
-            return 'root'
+    def _stats_file(self):
+        data = json.dumps(self._stats.snapshot(), indent=2, sort_keys=True)
+        data += '\n'
+        return data + ' ' * (-len(data) % self.CONTROL_PAD)
 
 
-    def _uid(self, user):
-        try:
-            return pwd.getpwnam(user).pw_uid
-        except KeyError:
-            self._logger.debug('No uid found for user %s, defaulting to 0',
-                               user)
-            return 0
+    def _warm_file(self):
+        with self._warm_lock:
+            data = json.dumps(self._warm_progress, indent=2, sort_keys=True)
+        data += '\n'
+        return data + ' ' * (-len(data) % self.CONTROL_PAD)
 
 
-    def _user(self, uid):
+    ######
+    ######
+    ## Cache warming methods
+    ##
+    ## Lines written to CONTROL_DIR/warm name paths in the mount, each as
+    ## 'meta <path>' or 'data <path>'.  Everything at or below each path
+    ## gets its status cached, and with 'data', every file's contents are
+    ## fetched into the data cache too, so a job that's about to read them
+    ## doesn't have to wait on the server for any of it.
+
+    def _warm(self, written):
+        wanted = []
+        for line in written.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            kind, _, path = line.partition(' ')
+            path = path.strip()
+            if kind not in ('meta', 'data') or not path.startswith('/'):
+                raise fuse.FuseOSError(errno.EINVAL)
+            wanted.append((os.path.normpath(path), kind == 'data'))
+
+        if any(data for path, data in wanted) and not self._warm_data:
+            self._logger.warning('Only warming metadata, since there\'s no '
+                                 '--cache-dir to keep file contents in')
+        user = self._current_user
+        for path, data in wanted:
+            self._warm_submit(path, data and self._warm_data, user)
+
+
+    def _warm_submit(self, path, data, user):
+        with self._warm_lock:
+            if self._warm_stopped:
+                return
+            self._warm_progress['pending'] += 1
+        self._warmer.submit(self._warm_path, path, data, user)
+
+
+    def _warm_count(self, name, n=1):
+        with self._warm_lock:
+            self._warm_progress[name] += n
+
+
+    def _warm_path(self, path, data, user):
+        # runs on the warmer pool.  a directory's listing caches all its
+        # children's statuses, and anything under it that still needs
+        # work goes back on the pool.
         try:
-            return pwd.getpwuid(uid).pw_name
-        except KeyError:
-            self._logger.debug('No user found for uid %s, defaulting to root',
-                               uid)
-            return 'root'
+            with self._warm_lock:
+                if self._warm_stopped:
+                    return
+            with self._acting_as(user):
+                hdfs_status = self._hdfs_status(path)
+                if hdfs_status['type'] != 'DIRECTORY':
+                    self._warm_count('files')
+                    if data:
+                        self._warm_count('bytes', self._warm_contents(path))
+                    return
+
+                self._warm_count('dirs')
+                for statuses in self._hdfs.list_pages(path, user=user):
+                    for child in statuses:
+                        child_path = os.path.join(path, child['pathSuffix'])
+                        self._attr_cache.put(child_path, child)
+                        if child['type'] == 'DIRECTORY' or data:
+                            self._warm_submit(child_path, data, user)
+                        else:
+                            self._warm_count('files')
+        except Exception as e:
+            self._logger.warning('Warming %s failed: %s', path, e)
+            self._warm_count('errors')
+        finally:
+            self._warm_count('pending', -1)
+
+
+    def _warm_contents(self, path):
+        # fetches all of a file into our local copy of it, which goes into
+        # the data cache once we let go of it.  returns its size.
+        self._wait_for_upload(path, check=False)
+        tmpfile = self._open_tmpfile(path)
+        try:
+            self._refresh_tmpfile(path)
+            with tmpfile['lock']:
+                size = tmpfile['remote_size']
+            self._fetch_blocks(path, 0, size)
+            return size
+        finally:
+            self._remove_tmpfile(path)
+
 
+    ######
+    ######
+    ## UID<->user, GID<->group lookup methods.
+    ##
+    ## The lookups themselves, and their caching, are up to self._ids.
 
     @property
     def _current_user(self):
+        # background threads have no fuse context, they act for whoever
+        # handed them their work
+        user = getattr(self._local, 'user', None)
+        if user is not None:
+            return user
         uid = fuse.fuse_get_context()[0]
-        return self._user(uid)
+        return self._ids.user(uid)
+
+
+    @contextlib.contextmanager
+    def _acting_as(self, user):
+        self._local.user = user
+        try:
+            yield
+        finally:
+            self._local.user = None
 
 
     def access(self, path, amode):
@@ -517,41 +2618,87 @@ class Javanicus(fuse.Operations):
 
     def chmod(self, path, mode):
         permissions = stat.S_IMODE(mode)
-        return self._hdfs.chmod(path, permissions, user=self._current_user)
+        try:
+            return self._hdfs.chmod(path, permissions, user=self._current_user)
+        finally:
+            self._invalidate_status(path)
 
 
     def chown(self, path, uid, gid):
         try:
             return self._hdfs.chown(path,
-                                    to_user=self._user(uid),
-                                    to_group=self._user(gid),
+                                    to_user=self._ids.user(uid),
+                                    to_group=self._ids.group(gid),
                                     user=self._current_user)
         except WebHDFS.WebHDFSPermissionError as e:
             raise fuse.FuseOSError(errno.EPERM)
+        finally:
+            self._invalidate_status(path)
 
 
     def create(self, path, mode):
-        assert path not in self._tmpfiles
+        self._wait_for_upload(path)
+        with self._tmpfiles_lock:
+            shared = path in self._tmpfiles
+        if shared:
+            # someone has it open already, so we just empty the copy we're
+            # all sharing, the way O_CREAT|O_TRUNC on an existing file would
+            return self.open(path, os.O_WRONLY | os.O_TRUNC)
+
         permissions = stat.S_IMODE(mode)
-        rv = self._hdfs.create(path, permissions, user=self._current_user)
-        if rv == 0:
-            # only open the tmpfile if the create call succeeds
-            self._open_tmpfile(path)
-            self._set_tmpfile_cksum(path)
-        return rv
+        try:
+            self._hdfs.create(path, permissions, user=self._current_user)
+        finally:
+            self._invalidate_status(path, parent=True)
+        # only open the tmpfile if the create call succeeds
+        self._open_tmpfile(path)
+        try:
+            self._set_tmpfile_version(path)
+        except Exception:
+            exc_info = sys.exc_info()
+            self._remove_tmpfile(path)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        return self._open_handle(path)
 
 
     def destroy(self, path):
+        # warming is abandoned, but finish any uploads still queued before
+        # we go
+        with self._warm_lock:
+            self._warm_stopped = True
+        self._warmer.close()
+        if self._uploader is not None:
+            self._uploader.close()
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        if self._fetcher is not None:
+            self._fetcher.close()
+        if self._part_uploader is not None:
+            self._part_uploader.close()
         self._hdfs.close()
         self._hdfs = None
-        shutil.rmtree(self._tmpdir)
+        self._cache.close()
+        if self._tracer is not None:
+            self._tracer.close()
 
 
     def flush(self, path, fh):
+        # with write-back on, or flushes deferred, release() takes care of
+        # uploading
+        if self._uploader is not None or self._defer_flush:
+            return 0
         return self.fsync(path, None, fh)
 
 
     def fsync(self, path, datasync, fh):
+        # a file nothing's changed in since it was last uploaded (by an
+        # earlier flush, say, of a dup'd descriptor) has nothing to check
+        # or send
+        tmpfile = self._tmpfiles[path]
+        with tmpfile['lock']:
+            if not self._tmpfile_dirty(path):
+                self._stats.count('uploads.skipped')
+                return 0
         self._refresh_tmpfile(path)
         self._push_tmpfile_if_dirty(path)
         return 0
@@ -559,7 +2706,7 @@ class Javanicus(fuse.Operations):
 
     def getattr(self, path, fh=None):
         try:
-            hdfs_status = self._hdfs.getattr(path, user=self._current_user)
+            hdfs_status = self._hdfs_status(path)
         except WebHDFS.WebHDFSFileNotFoundError as e:
             raise fuse.FuseOSError(errno.ENOENT)
 
@@ -568,54 +2715,150 @@ class Javanicus(fuse.Operations):
         #      and timestamps in status need to be seconds since epoch
         status = {
             'st_atime': hdfs_status['accessTime'] / float(1000),
-            'st_gid': self._gid(hdfs_status['group']),
+            'st_gid': self._ids.gid(hdfs_status['group']),
             'st_mode': (int(hdfs_status['permission'], 8)
                         | self.MODE_FLAGS[hdfs_status['type']]),
             'st_mtime': hdfs_status['modificationTime'] / float(1000),
             'st_size': hdfs_status['length'],
-            'st_uid': self._uid(hdfs_status['owner']),
+            'st_uid': self._ids.uid(hdfs_status['owner']),
         }
+
+        # a file that's closed but still waiting to be uploaded should look
+        # like what was written to it, not what the server has so far
+        with self._tmpfiles_lock:
+            if path in self._uploads and path in self._tmpfiles:
+                status['st_size'] = os.fstat(
+                    self._tmpfiles[path]['fh'].fileno()).st_size
         return status
 
 
+    def init(self, path):
+        # fuse has daemonized by now, so threads started here stick around
+        if self._signal_fd is not None:
+            thread = threading.Thread(target=self._log_stats_on_wakeup,
+                                      name='stats-signal')
+            thread.daemon = True
+            thread.start()
+
+
     def mkdir(self, path, mode):
         permissions = stat.S_IMODE(mode)
-        return self._hdfs.mkdir(path, permissions=permissions,
-                                user=self._current_user)
+        try:
+            return self._hdfs.mkdir(path, permissions=permissions,
+                                    user=self._current_user)
+        finally:
+            self._invalidate_status(path, parent=True)
 
 
     def open(self, path, flags):
-        if path in self._tmpfiles:
-            raise fuse.FuseOSError(errno.EIO)
-
-        tmp_fh = self._open_tmpfile(path)
-        self._refresh_tmpfile(path)
-        return 0
+        # nothing is checked against the server until it's read or written
+        # (see _refresh_tmpfile()), so opening is free.  O_TRUNC empties the
+        # file without fetching any of it.
+        self._wait_for_upload(path)
+        self._open_tmpfile(path)
+        fh = self._open_handle(path)
+        if flags & os.O_TRUNC:
+            try:
+                self.truncate(path, 0, fh)
+            except Exception:
+                exc_info = sys.exc_info()
+                with self._handles_lock:
+                    self._handles.pop(fh, None)
+                self._remove_tmpfile(path)
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return fh
 
 
     def read(self, path, size, offset, fh):
         self._refresh_tmpfile(path)
-        tmp_fh = self._tmpfiles[path]['fh']
-        tmp_fh.seek(offset)
-        return tmp_fh.read(size)
-
-
-    def readdir(self, path, fh):
-        statuses = self._hdfs.list(path, user=self._current_user)
-        dir_contents = ['.', '..'] + [s['pathSuffix'] for s in statuses]
-        return dir_contents
+        self._readahead(path, fh, offset, size)
+        tmpfile = self._tmpfiles[path]
+        with tmpfile['lock']:
+            missing = len(self._missing_blocks(tmpfile, offset, size))
+        self._stats.count('block_cache.misses', missing)
+        self._stats.count('block_cache.hits',
+                          len(self._blocks(offset, size)) - missing)
+        while True:
+            self._fetch_blocks(path, offset, size)
+            with tmpfile['lock']:
+                # a refresh in another thread may have tossed the blocks we
+                # just fetched, in which case we go around again
+                if not self._missing_blocks(tmpfile, offset, size):
+                    data = self._read_tmpfile(tmpfile, offset, size)
+                    self._stats.count('fuse.bytes_read', len(data))
+                    return data
+
+
+    def opendir(self, path):
+        fh = self._new_handle()
+        with self._handles_lock:
+            self._dirs[fh] = {'pages': None, 'page': [], 'start': 0}
+        return fh
+
+
+    def readdir(self, path, fh, offset=None):
+        # with an offset (see JavanicusFUSE), entries are generated as
+        # (name, attrs, offset of the next entry), and the listing is paged
+        # in from the server as the kernel asks for more of it.  without
+        # one, we just generate every name.
+        if offset is None:
+            state = {'pages': None, 'page': [], 'start': 0}
+            return (name for name, attrs, next_offset
+                    in self._dir_entries(path, state, 0))
+        with self._handles_lock:
+            state = self._dirs.get(fh)
+        if state is None:
+            state = {'pages': None, 'page': [], 'start': 0}
+        return self._dir_entries(path, state, offset)
+
+
+    def releasedir(self, path, fh):
+        with self._handles_lock:
+            self._dirs.pop(fh, None)
+        return 0
 
 
     def release(self, path, fh):
-        self._push_tmpfile_if_dirty(path)
-        self._remove_tmpfile(path)
+        # other handles still open on the path keep its local copy, and any
+        # changes in it, until the last of them is closed
+        with self._handles_lock:
+            self._handles.pop(fh, None)
+        with self._tmpfiles_lock:
+            tmpfile = self._tmpfiles[path]
+            if tmpfile['refs'] > 1:
+                tmpfile['refs'] -= 1
+                return 0
+            done = None
+            if self._uploader is not None and self._tmpfile_dirty(path):
+                done = threading.Event()
+                self._uploads[path] = done
+        if done is not None:
+            self._uploader.submit(self._writeback, path, self._current_user,
+                                  done)
+            return 0
+
+        # our reference goes either way, or the next open would share a
+        # copy that nobody's left to upload.  if the upload failed, the
+        # changes are dropped with it, and the next open of the path hears
+        # about it too.
+        try:
+            self._push_tmpfile_if_dirty(path)
+        except Exception as e:
+            with self._tmpfiles_lock:
+                self._upload_errors[path] = e
+            raise
+        finally:
+            self._remove_tmpfile(path)
         return 0
 
 
     def rename(self, old, new):
-        assert old not in self._tmpfiles and new not in self._tmpfiles
+        self._wait_for_upload(old, children=True, check=False)
+        self._wait_for_upload(new, children=True, check=False)
+        with self._tmpfiles_lock:
+            assert old not in self._tmpfiles and new not in self._tmpfiles
         try:
-            hdfs_status = self._hdfs.getattr(new, user=self._current_user)
+            hdfs_status = self._hdfs_status(new)
         except WebHDFS.WebHDFSFileNotFoundError as e:
             pass
         else:
@@ -624,43 +2867,77 @@ class Javanicus(fuse.Operations):
             except WebHDFS.WebHDFSDirectoryNotEmptyError as e:
                 raise fuse.FuseOSError(errno.ENOTEMPTY)
 
-        return self._hdfs.rename(old, new, user=self._current_user)
+        try:
+            return self._hdfs.rename(old, new, user=self._current_user)
+        finally:
+            self._cache.discard(old, children=True)
+            self._cache.discard(new, children=True)
+            self._invalidate_status(old, parent=True, children=True)
+            self._invalidate_status(new, parent=True, children=True)
 
 
     def rmdir(self, path):
-        assert not any(p.startswith(path) for p in self._tmpfiles)
+        self._wait_for_upload(path, children=True, check=False)
+        with self._tmpfiles_lock:
+            assert not any(p.startswith(path) for p in self._tmpfiles)
         try:
             return self._hdfs.delete(path, user=self._current_user)
         except WebHDFS.WebHDFSDirectoryNotEmptyError as e:
             raise fuse.FuseOSError(errno.ENOTEMPTY)
+        finally:
+            self._cache.discard(path, children=True)
+            self._invalidate_status(path, parent=True, children=True)
 
 
     def truncate(self, path, length, fh=None):
         def _truncate(self, path):
-            self._refresh_tmpfile(path)
-
-            # now, truncate locally
-            tmp_fh = self._tmpfiles[path]['fh']
-            tmp_fh.truncate(length)
-
-            # flag it dirty, push it to the server
-            self._tmpfiles[path]['dirty'] = True
-            self._push_tmpfile_if_dirty(path)
+            # none of the server's data survives truncating to zero, so
+            # there's no need to check our copy against it first.  we do
+            # have to send the full (empty) file then, not append to
+            # whatever the server has.
+            if length:
+                self._refresh_tmpfile(path)
+
+            # now, truncate locally.  only the blocks we're keeping need
+            # the server's data, and anything past the new length must never
+            # be fetched back in if the file grows again.
+            tmpfile = self._tmpfiles[path]
+            with tmpfile['lock']:
+                self._fetch_blocks(path, 0, length)
+                self._wait_for_pending(tmpfile)
+                tmp_fh = tmpfile['fh']
+                tmp_fh.seek(0, os.SEEK_END)
+                old_length = tmp_fh.tell()
+                tmp_fh.truncate(length)
+                if not length:
+                    tmpfile['version'] = None
+                    tmpfile['remote_size'] = 0
+                    tmpfile['partial'] = {}
+                tmpfile['blocks'].update(self._blocks(
+                    length, max(tmpfile['remote_size'] - length, 0)))
+
+                # flag it dirty, push it to the server
+                self._mark_tmpfile_dirty(path, min(length, old_length))
+                self._push_tmpfile_if_dirty(path)
             return 0
 
-        # a file doesn't have to be open to call truncate on it
-        if path not in self._tmpfiles:
-            self._open_tmpfile(path)
-            try:
-               return _truncate(self, path)
-            finally:
-                self._remove_tmpfile(path)
-        else:
+        # a file doesn't have to be open to call truncate on it.  if it is,
+        # we just share its local copy for the duration.
+        self._wait_for_upload(path)
+        self._open_tmpfile(path)
+        try:
             return _truncate(self, path)
+        finally:
+            self._remove_tmpfile(path)
 
 
     def unlink(self, path):
-        return self._hdfs.delete(path, user=self._current_user)
+        self._wait_for_upload(path, check=False)
+        try:
+            return self._hdfs.delete(path, user=self._current_user)
+        finally:
+            self._cache.discard(path)
+            self._invalidate_status(path, parent=True)
 
 
     def utimens(self, path, times=None):
@@ -669,40 +2946,289 @@ class Javanicus(fuse.Operations):
         else:
             now = time.time()
             atime, mtime = now, now
-        return self._hdfs.utime(path, atime, mtime, user=self._current_user)
+        with self._tmpfiles_lock:
+            tmpfile = self._tmpfiles.get(path)
+        if tmpfile is not None:
+            with tmpfile['lock']:
+                version = tmpfile['version']
+        try:
+            self._hdfs.utime(path, atime, mtime, user=self._current_user)
+        finally:
+            self._invalidate_status(path)
+
+        # with versions made of the modification time and length, our own
+        # change to the time would look like the file changing on the
+        # server, and toss any changes to an open copy of it (see
+        # _refresh_tmpfile()).  so if the copy matched what the server had
+        # before, it matches what it has now.
+        if (tmpfile is not None and self._validate == 'status'
+                and version is not None):
+            new_version, _ = self._remote_version(path)
+            with tmpfile['lock']:
+                if (tmpfile['version'] == version
+                        and version[1] == new_version[1]):
+                    tmpfile['version'] = new_version
+        return 0
 
 
     def write(self, path, data, offset, fh):
         self._refresh_tmpfile(path)
 
-        tmp_fh = self._tmpfiles[path]['fh']
-        tmp_fh.seek(offset)
-        tmp_fh.write(data)
-        self._logger.debug('Wrote %s bytes to temp copy of %s',
-                           len(data), path)
-        self._tmpfiles[path]['dirty'] = True
+        tmpfile = self._tmpfiles[path]
+        with tmpfile['lock']:
+            # a block we write into the middle of needs the server's data
+            # up to that point first, unless our own writes already reach
+            # it, or it's past the end of what the server has (appending
+            # never needs the server's bytes).  what's left of a block we
+            # write into can wait until somebody reads it, or we upload, so
+            # writing a file from start to finish never fetches any of it.
+            # either way, a fetch still in flight mustn't land on our data.
+            bs = self._block_size
+            end = offset + len(data)
+            partial = tmpfile['partial']
+            if (offset % bs and offset < tmpfile['remote_size']
+                    and partial.get(offset // bs, -1) < offset):
+                self._fetch_blocks(path, offset, 1)
+            self._wait_for_pending(tmpfile, offset, len(data))
+
+            pwrite(tmpfile['fh'].fileno(), data, offset)
+            self._logger.debug('Wrote %s bytes to temp copy of %s',
+                               len(data), path)
+            for block in self._blocks(offset, len(data)):
+                if block in tmpfile['blocks']:
+                    continue
+                # our write only adds to what's valid from the start of the
+                # block if it starts within that.  if not, the server's
+                # bytes before it are still missing, and get fetched from
+                # there up to the end of what the server has, which stops
+                # short of our write.
+                start = block * bs
+                valid = partial.pop(block, start)
+                if max(offset, start) <= valid:
+                    valid = max(valid, min(end, start + bs))
+                if valid >= min(start + bs, tmpfile['remote_size']):
+                    tmpfile['blocks'].add(block)
+                elif valid > start:
+                    partial[block] = valid
+            self._mark_tmpfile_dirty(path, offset)
+        self._stats.count('fuse.bytes_written', len(data))
         return len(data)
 
 
+class JavanicusFUSE(fuse.FUSE):
+    '''
+    fuse.FUSE doesn't pass the offset the kernel asks for through to
+    readdir, which we need in order to page through big directories
+    instead of listing them in full every time.
+    '''
+    def readdir(self, path, buf, filler, offset, fip):
+        for name, attrs, next_offset in self.operations(
+                'readdir', path.decode(self.encoding), fip.contents.fh,
+                offset):
+            if filler(buf, name.encode(self.encoding), None,
+                      next_offset) != 0:
+                break
+        return 0
+
+
+def warm(argv):
+    '''
+    javanicus.py warm [--data] <mount> <path>...
+
+    Asks the javanicus mounted at mount to warm its caches with everything
+    at or below each path (see Javanicus._warm()), and reports its progress
+    until it's done.
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='javanicus.py warm',
+        description='Warm the caches of a javanicus mount')
+    parser.add_argument('--data', action='store_true', default=False,
+                        help='fetch file contents too, which needs the mount '
+                             'to have a --cache-dir')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between progress reports')
+    parser.add_argument('mount')
+    parser.add_argument('paths', nargs='+', metavar='path',
+                        help='paths in the mount to warm')
+    args = parser.parse_args(argv)
+
+    mount = os.path.abspath(args.mount)
+    lines = []
+    for path in args.paths:
+        relative = os.path.relpath(os.path.abspath(path), mount)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            parser.error('%s is not in %s' % (path, mount))
+        lines.append('%s %s\n' % ('data' if args.data else 'meta',
+                                  os.path.normpath('/' + relative)))
+
+    # progress is counted over the life of the mount, so we report how far
+    # it's come since we started
+    control = os.path.join(mount, Javanicus.CONTROL_DIR.lstrip('/'), 'warm')
+    def progress():
+        with open(control) as control_fh:
+            return json.load(control_fh)
+    start = progress()
+    with open(control, 'w') as control_fh:
+        control_fh.write(''.join(lines))
+
+    while True:
+        current = progress()
+        done = dict((name, current[name] - start[name])
+                    for name in ('dirs', 'files', 'bytes', 'errors'))
+        sys.stderr.write('%d directories, %d files, %d bytes, %d errors, '
+                         '%d pending\n'
+                         % (done['dirs'], done['files'], done['bytes'],
+                            done['errors'], current['pending']))
+        if not current['pending']:
+            break
+        time.sleep(args.interval)
+    return 1 if done['errors'] else 0
+
+
 def main():
+    if sys.argv[1:2] == ['warm']:
+        return warm(sys.argv[2:])
+
     import logging
     logging.basicConfig()
 
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument('host')
+    parser.add_argument('host',
+                        help='namenode host, or for HA, a comma separated '
+                             'list of namenodes as host or host:port')
     parser.add_argument('--port', type=int, default=50070)
     parser.add_argument('mount')
     parser.add_argument('--debug', action='store_true', default=False)
     parser.add_argument('--foreground', action='store_true', default=False)
+    parser.add_argument('--block-size', type=int,
+                        default=Javanicus.BLOCK_SIZE,
+                        help='bytes fetched per block of a local copy')
+    parser.add_argument('--attr-timeout', type=float,
+                        default=Javanicus.ATTR_TIMEOUT,
+                        help='seconds to cache file statuses for')
+    parser.add_argument('--attr-cache-size', type=int,
+                        default=Javanicus.ATTR_CACHE_SIZE,
+                        help='max number of file statuses to cache')
+    parser.add_argument('--negative-timeout', type=float,
+                        default=Javanicus.NEGATIVE_TIMEOUT,
+                        help='seconds to remember missing paths for, 0 to '
+                             'disable')
+    parser.add_argument('--negative-cache-size', type=int,
+                        default=Javanicus.NEGATIVE_CACHE_SIZE,
+                        help='max number of missing paths to remember')
+    parser.add_argument('--validate', choices=Javanicus.VALIDATE_MODES,
+                        default='status',
+                        help='how to check local copies against the server')
+    parser.add_argument('--lease', type=float, default=Javanicus.LEASE,
+                        help='seconds to trust a checked local copy for')
+    parser.add_argument('--cache-dir', default=None,
+                        help='keep local copies here, across opens and mounts')
+    parser.add_argument('--cache-size', type=int,
+                        default=Javanicus.CACHE_SIZE,
+                        help='most bytes of local copies to keep in '
+                             '--cache-dir')
+    parser.add_argument('--readahead-min', type=int,
+                        default=Javanicus.READAHEAD_MIN,
+                        help='blocks to prefetch once reads look sequential')
+    parser.add_argument('--readahead-max', type=int,
+                        default=Javanicus.READAHEAD_MAX,
+                        help='most blocks to prefetch ahead, 0 to disable')
+    parser.add_argument('--parallel-fetches', type=int,
+                        default=Javanicus.PARALLEL_FETCHES,
+                        help='ranges of a big download to fetch at once, '
+                             '1 to disable')
+    parser.add_argument('--parallel-threshold', type=int,
+                        default=Javanicus.PARALLEL_THRESHOLD,
+                        help='bytes a download needs before it is split up')
+    parser.add_argument('--parallel-uploads', type=int,
+                        default=Javanicus.PARALLEL_UPLOADS,
+                        help='parts of a big upload to send at once, '
+                             '1 to disable')
+    parser.add_argument('--upload-threshold', type=int,
+                        default=Javanicus.UPLOAD_THRESHOLD,
+                        help='bytes an upload needs before it is split up')
+    parser.add_argument('--upload-part-size', type=int,
+                        default=Javanicus.UPLOAD_PART_SIZE,
+                        help='bytes per part of a split upload, and the '
+                             'block size the parts are created with')
+    parser.add_argument('--writeback', action='store_true', default=False,
+                        help='upload closed files in the background')
+    parser.add_argument('--upload-workers', type=int,
+                        default=Javanicus.UPLOAD_WORKERS,
+                        help='background upload threads for --writeback')
+    parser.add_argument('--warm-workers', type=int,
+                        default=Javanicus.WARM_WORKERS,
+                        help='threads warming caches for "javanicus.py '
+                             'warm"')
+    parser.add_argument('--defer-flush', action='store_true', default=False,
+                        help='upload files on their last close rather than '
+                             'every flush, fsync still uploads')
+    parser.add_argument('--stats-signal', action='store_true', default=False,
+                        help='log stats when sent SIGUSR1, they can always '
+                             'be read from %s/stats in the mount'
+                             % Javanicus.CONTROL_DIR)
+    parser.add_argument('--trace',
+                        help='file to record every operation to, for '
+                             'replay.py')
+    parser.add_argument('--id-map',
+                        help='file mapping hdfs users and groups with no '
+                             'local account to uids and gids')
+    parser.add_argument('--threads', action='store_true', default=False,
+                        help='handle filesystem operations concurrently')
+    parser.add_argument('--max-requests', type=int,
+                        default=WebHDFS.MAX_REQUESTS,
+                        help='max WebHDFS requests in flight at once')
+    parser.add_argument('--max-data-requests', type=int,
+                        default=WebHDFS.MAX_DATA_REQUESTS,
+                        help='how many of those can be reading or writing '
+                             'file data, the rest are kept for metadata')
+    parser.add_argument('--pool-hosts', type=int, default=WebHDFS.POOL_HOSTS,
+                        help='number of hosts to keep connection pools for')
+    parser.add_argument('--pool-size', type=int, default=WebHDFS.POOL_SIZE,
+                        help='idle connections to keep open to each host')
+    parser.add_argument('--redirect-ttl', type=float,
+                        default=WebHDFS.REDIRECT_TTL,
+                        help='seconds to remember datanode redirects for')
     args = parser.parse_args()
 
-    javanicus = Javanicus(args.host, args.port, args.mount, args.debug)
-    fs = fuse.FUSE(javanicus,
-                   args.mount,
-                   foreground=args.foreground,
-                   nothreads=True,
-                   debug=args.debug)
+    javanicus = Javanicus(args.host.split(','), args.port, args.mount,
+                          args.debug,
+                          block_size=args.block_size,
+                          attr_timeout=args.attr_timeout,
+                          attr_cache_size=args.attr_cache_size,
+                          negative_timeout=args.negative_timeout,
+                          negative_cache_size=args.negative_cache_size,
+                          validate=args.validate,
+                          lease=args.lease,
+                          cache_dir=args.cache_dir,
+                          cache_size=args.cache_size,
+                          readahead_min=args.readahead_min,
+                          readahead_max=args.readahead_max,
+                          parallel_fetches=args.parallel_fetches,
+                          parallel_threshold=args.parallel_threshold,
+                          parallel_uploads=args.parallel_uploads,
+                          upload_threshold=args.upload_threshold,
+                          upload_part_size=args.upload_part_size,
+                          writeback=args.writeback,
+                          upload_workers=args.upload_workers,
+                          defer_flush=args.defer_flush,
+                          warm_workers=args.warm_workers,
+                          id_map=args.id_map,
+                          trace=args.trace,
+                          max_requests=args.max_requests,
+                          max_data_requests=args.max_data_requests,
+                          pool_hosts=args.pool_hosts,
+                          pool_size=args.pool_size,
+                          redirect_ttl=args.redirect_ttl)
+    if args.stats_signal:
+        javanicus.log_stats_on(signal.SIGUSR1)
+    fs = JavanicusFUSE(javanicus,
+                       args.mount,
+                       foreground=args.foreground,
+                       nothreads=not args.threads,
+                       debug=args.debug)
     return 0
 
 
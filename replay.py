@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+'''
+Plays back a trace recorded with javanicus.py --trace.
+
+By default the trace is played against a fresh Javanicus instance talking to
+fakewebhdfs, which is seeded with every file and directory the trace saw
+before it was created, at the sizes it saw them.  With --mount it's played
+through the filesystem calls of a real mount instead.  Either way, each
+thread of the trace is played back on a thread of its own, with each
+operation started when it was in the recording (scaled by --speed, or as
+soon as the last one finishes with --speed 0).
+
+Results are written as json, with the number of operations of each kind,
+their median and 99th percentile latency in the recording and in the
+replay, and how many WebHDFS requests each made.
+
+    $ ./javanicus.py namenode /mnt/hdfs --trace job.trace
+    $ ./replay.py job.trace --latency 2 --output before.json
+    $ ./replay.py job.trace --latency 2 --option readahead_max=0
+    $ ./replay.py job.trace --mount /mnt/hdfs --speed 0
+'''
+
+import argparse
+import collections
+import errno
+import itertools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import fuse
+
+import javanicus
+from benchmark import MB, parse_option, percentile
+from fakewebhdfs import FakeWebHDFS
+
+
+# which argument of each op is a file handle, so handles from the recording
+# can be swapped for the ones we get in the replay
+FH_ARGS = {
+    'fsync': 2,
+    'flush': 1,
+    'getattr': 1,
+    'read': 3,
+    'readdir': 1,
+    'release': 1,
+    'releasedir': 1,
+    'truncate': 2,
+    'write': 3,
+}
+
+# ops that hand out a file handle
+OPENS = ('create', 'open', 'opendir')
+
+# ops a replay starts and ends by itself
+SKIPPED = ('destroy', 'init', 'webhdfs')
+
+
+def load(path):
+    with open(path) as f:
+        header = json.loads(f.readline())
+        if header.get('format') != javanicus.Tracer.FORMAT:
+            raise ValueError('%s is not a trace javanicus.py --trace wrote'
+                             % path)
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def seed(fs, records):
+    # anything the trace saw exist before it created it was there from the
+    # start.  file contents don't matter, only their sizes.  children that
+    # were only ever listed, and never looked at, are taken to be empty
+    # files, unless something turns up below them.
+    created = set()
+    seen = {}
+    for record in sorted(records, key=lambda r: r['start']):
+        op, args = record['op'], record.get('args') or []
+        if 'error' in record or not args or args[0].startswith(
+                javanicus.Javanicus.CONTROL_DIR):
+            continue
+        if op in ('create', 'mkdir', 'symlink'):
+            created.add(args[0])
+        elif op == 'rename':
+            created.add(args[1])
+        elif op == 'getattr' and args[0] not in created:
+            if seen.get(args[0]) is None:
+                seen[args[0]] = record.get('result') or {}
+        elif op == 'readdir' and args[0] not in created:
+            if seen.get(args[0]) is None:
+                seen[args[0]] = {'dir': True}
+            for name in record.get('entries', []):
+                child = os.path.join(args[0], name)
+                if name not in ('.', '..') and child not in created:
+                    seen.setdefault(child, None)
+
+    parents = set(os.path.dirname(path) for path in seen)
+    for path in sorted(seen):
+        status = seen[path] or {}
+        if status.get('dir') or path in parents:
+            fs.mkdirs(path)
+        else:
+            fs.write_file(path, '\0' * (status.get('size') or 0))
+
+
+######
+######
+## Targets
+##
+## What a replay drives.  Each one's call() takes an op, its arguments as
+## recorded (handles and all) and its recorded result, and returns what the
+## op returned.
+
+class DirectTarget(object):
+    '''
+    Calls a Javanicus instance, the way fuse would.
+    '''
+    def __init__(self, mount):
+        self._mount = mount
+
+
+    def call(self, op, args, recorded):
+        if op == 'write':
+            args = [args[0], '\0' * args[1]] + args[2:]
+        result = self._mount(op, *args)
+        if op == 'readdir':
+            # the listing happens as it's iterated, and only as far as it
+            # was in the recording, so it's paged in the same way
+            result = list(itertools.islice(result, recorded))
+        return result
+
+
+    def close(self):
+        self._mount('destroy', '/')
+
+
+class MountTarget(object):
+    '''
+    Makes the system calls that would have produced each op on a mount.
+    Ops with no system call of their own (flush, say) are skipped.
+    '''
+    def __init__(self, root):
+        self._root = root
+        self._listings = {}
+
+
+    def _path(self, path):
+        return os.path.join(self._root, path.lstrip('/'))
+
+
+    def call(self, op, args, recorded):
+        try:
+            return self._call(op, args)
+        except (IOError, OSError) as e:
+            raise fuse.FuseOSError(e.errno)
+
+
+    def _call(self, op, args):
+        path = self._path(args[0]) if args else None
+        if op == 'access':
+            if not os.access(path, args[1]):
+                raise fuse.FuseOSError(errno.EACCES)
+        elif op == 'chmod':
+            os.chmod(path, args[1])
+        elif op == 'chown':
+            os.chown(path, args[1], args[2])
+        elif op == 'create':
+            return os.open(path, os.O_CREAT | os.O_TRUNC | os.O_WRONLY,
+                           args[1])
+        elif op == 'fsync':
+            os.fsync(args[2])
+        elif op == 'getattr':
+            os.lstat(path)
+        elif op == 'mkdir':
+            os.mkdir(path, args[1])
+        elif op == 'open':
+            return os.open(path, args[1])
+        elif op == 'opendir':
+            fd = os.open(path, os.O_RDONLY)
+            self._listings[fd] = path
+            return fd
+        elif op == 'read':
+            os.lseek(args[3], args[2], os.SEEK_SET)
+            return os.read(args[3], args[1])
+        elif op == 'readdir':
+            # the kernel pages through a listing by itself, so only the
+            # first call for a directory handle lists it
+            if len(args) < 3 or not args[2]:
+                return os.listdir(self._listings.get(args[1], path))
+        elif op == 'release':
+            os.close(args[1])
+        elif op == 'releasedir':
+            self._listings.pop(args[1], None)
+            os.close(args[1])
+        elif op == 'rename':
+            os.rename(path, self._path(args[1]))
+        elif op == 'rmdir':
+            os.rmdir(path)
+        elif op == 'truncate':
+            if len(args) > 2 and args[2] is not None:
+                os.ftruncate(args[2], args[1])
+            else:
+                with open(path, 'r+b') as f:
+                    f.truncate(args[1])
+        elif op == 'unlink':
+            os.unlink(path)
+        elif op == 'utimens':
+            os.utime(path, tuple(args[1]) if len(args) > 1 and args[1]
+                           else None)
+        elif op == 'write':
+            os.lseek(args[3], args[2], os.SEEK_SET)
+            return os.write(args[3], '\0' * args[1])
+        return None
+
+
+    def close(self):
+        pass
+
+
+######
+######
+## Replay
+
+def play(target, records, speed):
+    # one thread per recorded thread, each working through its own ops in
+    # order, and waiting for each one's start time if there's a speed
+    threads = collections.OrderedDict()
+    for record in sorted(records, key=lambda r: r['start']):
+        threads.setdefault(record['thread'], []).append(record)
+    first = min([r['start'] for r in records] or [0])
+
+    handles = {}
+    handles_lock = threading.Lock()
+    results = []
+    start = time.time()
+
+    def run(ops):
+        for record in ops:
+            if speed:
+                delay = (start + (record['start'] - first) / speed
+                         - time.time())
+                if delay > 0:
+                    time.sleep(delay)
+
+            args = list(record.get('args') or [])
+            index = FH_ARGS.get(record['op'])
+            if index is not None and index < len(args):
+                with handles_lock:
+                    args[index] = handles.get(args[index], args[index])
+
+            op_start = time.time()
+            error = None
+            try:
+                result = target.call(record['op'], args,
+                                     record.get('result'))
+            except fuse.FuseOSError as e:
+                error = e.errno
+            except Exception as e:
+                error = repr(e)
+            else:
+                if record['op'] in OPENS:
+                    with handles_lock:
+                        handles[record.get('result')] = result
+            results.append({'op': record['op'],
+                            'ms': (time.time() - op_start) * 1000,
+                            'error': error,
+                            'recorded_error': record.get('error')})
+
+    workers = [threading.Thread(target=run, args=(ops,), name=name)
+               for name, ops in threads.iteritems()]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results, time.time() - start
+
+
+def summarize(records, results):
+    recorded = collections.defaultdict(list)
+    for record in records:
+        recorded[record['op']].append(record)
+    replayed = collections.defaultdict(list)
+    for result in results:
+        replayed[result['op']].append(result)
+
+    ops = {}
+    for op in sorted(replayed):
+        before = sorted(r['ms'] for r in recorded[op])
+        after = sorted(r['ms'] for r in replayed[op])
+        ops[op] = {
+            'count': len(after),
+            'recorded_p50_ms': percentile(before, 0.50),
+            'recorded_p99_ms': percentile(before, 0.99),
+            'replay_p50_ms': percentile(after, 0.50),
+            'replay_p99_ms': percentile(after, 0.99),
+            'recorded_requests': sum(len(r.get('requests', []))
+                                     for r in recorded[op]),
+            # an op that failed differently than it did in the recording
+            # means the replay didn't reproduce its workload faithfully
+            'mismatched_errors': sum(
+                1 for r in replayed[op]
+                if (r['error'] is None) != (r['recorded_error'] is None)),
+        }
+    return ops
+
+
+def span(records):
+    # seconds from the start of the first op to the end of the last
+    if not records:
+        return 0.0
+    return (max(r['start'] + r['ms'] / 1000.0 for r in records)
+            - min(r['start'] for r in records))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replay a javanicus trace')
+    parser.add_argument('trace', help='file written by javanicus.py --trace')
+    parser.add_argument('--mount',
+                        help='replay through this javanicus mount, instead '
+                             'of against a fake WebHDFS cluster')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='how many times faster than recorded to play '
+                             'it back, 0 for as fast as possible')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds of latency to add to each fake '
+                             'request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='fake datanode bandwidth to simulate, in MB/s')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='entries per page of a fake batched listing')
+    parser.add_argument('--option', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='pass an option through to Javanicus, eg. '
+                             'readahead_max=0 or writeback=true')
+    parser.add_argument('--output', default='-',
+                        help='where to write the json results')
+    args = parser.parse_args()
+
+    records = load(args.trace)
+    replayable = [r for r in records
+                  if r['op'] not in SKIPPED
+                  and not (r.get('args') or [''])[0].startswith(
+                      javanicus.Javanicus.CONTROL_DIR)]
+    logging.basicConfig(level=logging.WARN)
+
+    fs = None
+    if args.mount is not None:
+        target = MountTarget(args.mount)
+    else:
+        fs = FakeWebHDFS(latency=args.latency / 1000.0,
+                         bandwidth=args.bandwidth * MB
+                                   if args.bandwidth else None,
+                         batch_size=args.batch_size).start()
+        seed(fs, records)
+        fs.reset_counts()
+        options = dict(parse_option(option) for option in args.option)
+        # there's no fuse context outside of a mount, so everything runs
+        # as us
+        fuse.fuse_get_context = lambda: (os.getuid(), os.getgid(),
+                                         os.getpid())
+        target = DirectTarget(javanicus.Javanicus(fs.host, fs.port,
+                                                  debug=False, **options))
+
+    try:
+        results, elapsed = play(target, replayable, args.speed)
+        target.close()
+    finally:
+        if fs is not None:
+            fs.stop()
+
+    output = {
+        'trace': args.trace,
+        'config': {
+            'mount': args.mount,
+            'speed': args.speed,
+            'options': args.option,
+        },
+        'recorded_seconds': span(replayable),
+        'replay_seconds': elapsed,
+        'recorded_requests': sum(len(r.get('requests', []))
+                                 for r in records),
+        'ops': summarize(replayable, results),
+    }
+    if fs is not None:
+        output['replay_requests'] = dict(('%s.%s' % key, n)
+                                         for key, n in fs.counts.items())
+    sys.stderr.write('%d ops replayed in %.2fs (recorded in %.2fs)\n'
+                     % (len(results), elapsed, output['recorded_seconds']))
+
+    if args.output == '-':
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+            f.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())